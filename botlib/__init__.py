@@ -1,16 +1,37 @@
 from .api_interface import ApiInterface
-from .bot_exceptions import InvalidCrypto, FetchError
+from .bot_exceptions import InvalidCrypto, FetchError, QueueFull
 from .bot_help import CommandsHelp
+from .cache import LRUCache
+from .classification import ClassificationService
 from .content_generator import ContentGenerator
+from .generation_scheduler import GenerationScheduler
+from .http_client import HttpClient
+from .ingestion import IngestionPipeline
+from .lazy_loader import LazyLoader, LoadReport, load_report
 from .nlp_tools import NlpTools
 from .scraper import Scraper
+from .search_index import SearchIndex
+from .streaming import stream_in_executor
+from .synset_index import SynsetIndex
 
 __all__ = [
     "ApiInterface",
     "InvalidCrypto",
     "FetchError",
+    "QueueFull",
     "CommandsHelp",
+    "LRUCache",
+    "ClassificationService",
     "ContentGenerator",
+    "GenerationScheduler",
+    "HttpClient",
+    "IngestionPipeline",
+    "LazyLoader",
+    "LoadReport",
+    "load_report",
     "NlpTools",
     "Scraper",
+    "SearchIndex",
+    "stream_in_executor",
+    "SynsetIndex",
 ]
@@ -1,22 +1,62 @@
-import aiohttp
-import plotly.graph_objects as go
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import re
 import datetime
 import json
+import time
+import numpy as np
 from .bot_exceptions import InvalidCrypto, FetchError
+from .cache import LRUCache
+from .charts import render_price_chart, render_comparison_chart
+from .downsampling import lttb
+from .http_client import HttpClient
+from .price_store import PriceStore, DAY_MS
 
 
 class ApiInterface:
     BASE_URL = "https://api.coincap.io/v2/assets"
+    # Api intervals, finest first, with their length in milliseconds
+    INTERVALS = (
+        ("m5", 5 * 60 * 1000),
+        ("m15", 15 * 60 * 1000),
+        ("m30", 30 * 60 * 1000),
+        ("h1", 60 * 60 * 1000),
+        ("h2", 2 * 60 * 60 * 1000),
+        ("h6", 6 * 60 * 60 * 1000),
+        ("h12", 12 * 60 * 60 * 1000),
+        ("d1", DAY_MS),
+    )
+    # Points of a chart, a 800px wide chart can't show more
+    MAX_CHART_POINTS = 500
+    # Assets of a single comparison chart
+    MAX_COMPARE_ASSETS = 6
+    # Requests to the api at the same time
+    MAX_CONCURRENT_REQUESTS = 4
 
-    def __init__(self, api_key) -> None:
-        self.headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Accept": "application/json",
-        }
+    def __init__(self, api_key, http_client: HttpClient) -> None:
+        self.http_client = http_client
+        self.http_client.register(
+            "coincap",
+            headers={
+                "Authorization": f"Bearer {api_key}",
+                "Accept": "application/json",
+            },
+            timeout=20,
+        )
         with open("data/assets.json", "r") as f:
             self.assets = json.load(f)
+        # Basic info (price, rank, ...) changes often, it is only kept for a minute
+        self.info_cache = LRUCache(maxsize=256, ttl=60)
+        self.price_store = PriceStore()
+        # Intraday histories are not stored, only kept for a few minutes
+        self.history_cache = LRUCache(maxsize=64, ttl=300)
+        self.chart_cache = LRUCache(maxsize=64)
+        self.request_semaphore = asyncio.Semaphore(self.MAX_CONCURRENT_REQUESTS)
+        # Kaleido already renders in its own process, the thread only waits for it
+        # (and builds the figure) outside of the event loop.
+        self.render_executor = ThreadPoolExecutor(
+            max_workers=2, thread_name_prefix="charts"
+        )
 
     def validate_symbol(self, symbol: str) -> bool:
         exp = r"^[A-Za-z]{2,5}"
@@ -26,87 +66,218 @@ class ApiInterface:
         exp = r"\d{4}-\d{1,2}-\d{1,2}\.\d{4}-\d{1,2}-\d{1,2}"
         return re.fullmatch(exp, interval) is not None
 
-    def create_graph(self, data: dict, asset_id: str) -> str:
-        # Create a graph of the data
-        x = []
-        y = []
-        for d in data:
-            y.append(float(d["priceUsd"]))
-            x.append(datetime.datetime.fromtimestamp(d["time"] / 1e3))
-
-        fig = go.Figure(data=go.Scatter(x=x, y=y))
-
-        fig.update_layout(
-            title=f"{asset_id.capitalize()} price over time",
-            xaxis_title="Date",
-            yaxis_title="Price [USD]",
-            title_x=0.5,
-            template="plotly_dark",
-            plot_bgcolor="black",
-            paper_bgcolor="black",
-            font=dict(color="white"),
-            xaxis=dict(gridcolor="gray"),
-            yaxis=dict(gridcolor="gray"),
-            margin=dict(l=70, r=30, t=50, b=50),
-        )
-        path = f"{asset_id}.png"
-        fig.write_image(path, width=800, height=600, scale=3)
-        return path
+    def pick_interval(self, start_ms: int, end_ms: int) -> str:
+        """
+        returns:
+            str: finest api interval that keeps the range under MAX_CHART_POINTS
+        """
+        for interval, length in self.INTERVALS:
+            if (end_ms - start_ms) / length <= self.MAX_CHART_POINTS:
+                return interval
+        return "d1"
 
-    async def fetch_data(
-        self, ticker: str, start_date: datetime = None, end_date: datetime = None
-    ) -> tuple:
+    async def create_graph(
+        self, asset_id: str, times: np.ndarray, prices: np.ndarray, key: tuple
+    ) -> bytes:
+        """
+        Parameters:
+            :key: Identifies the range and version of the data, same key -> same image.
+        """
+        image = self.chart_cache.get(key)
+        if image is None:
+            times, prices = lttb(times, prices, self.MAX_CHART_POINTS)
+            loop = asyncio.get_running_loop()
+            image = await loop.run_in_executor(
+                self.render_executor,
+                render_price_chart,
+                times,
+                prices,
+                f"{asset_id.capitalize()} price over time",
+            )
+            self.chart_cache.put(key, image)
+        return image
+
+    async def create_comparison_graph(self, series: list, key: tuple) -> bytes:
+        """
+        Parameters:
+            :series: [(asset_id, times, prices), ...] of the assets to compare.
+            :key: Identifies the ranges and versions of the data, same key -> same image.
+        """
+        image = self.chart_cache.get(key)
+        if image is None:
+            series = [
+                (asset_id.capitalize(), *lttb(times, prices, self.MAX_CHART_POINTS))
+                for asset_id, times, prices in series
+            ]
+            loop = asyncio.get_running_loop()
+            image = await loop.run_in_executor(
+                self.render_executor,
+                render_comparison_chart,
+                series,
+                "Return over time",
+            )
+            self.chart_cache.put(key, image)
+        return image
+
+    def asset_id(self, ticker: str) -> str:
         asset_id = self.assets.get(ticker.upper())
         if asset_id is None:
             raise InvalidCrypto(ticker, self.assets.keys())
+        return asset_id
+
+    def time_range(
+        self, start_date: datetime = None, end_date: datetime = None
+    ) -> tuple:
+        """
+        returns:
+            tuple: (start_ms, end_ms) of the dates, expanded to whole days
+        """
+        if not (start_date and end_date):
+            # Defaults to the last year
+            end_date = datetime.datetime.utcnow()
+            start_date = end_date - datetime.timedelta(days=365)
+        # Datetime to unix timestamp in milliseconds (api requirement)
+        start_date = start_date.replace(tzinfo=datetime.timezone.utc).timestamp() * 1e3
+        end_date = end_date.replace(tzinfo=datetime.timezone.utc).timestamp() * 1e3
+        return PriceStore.align(int(start_date), int(end_date))
 
-        date_arg = ""
-        if start_date and end_date:
-            # Datetime to unix timestamp in milliseconds (api requirement)
-            start_date = (
-                start_date.replace(tzinfo=datetime.timezone.utc).timestamp() * 1e3
+    async def fetch_info(self, *asset_ids: str) -> list:
+        """
+        Basic info of the assets, the ones that are not cached are fetched
+        with a single request.
+
+        returns:
+            list: basic info of each asset, in the same order as asset_ids
+        """
+        infos = {asset_id: self.info_cache.get(asset_id) for asset_id in asset_ids}
+        missing = [asset_id for asset_id, info in infos.items() if info is None]
+        if missing:
+            (results,) = await self.get_all_data(
+                f"{self.BASE_URL}?ids={','.join(missing)}"
             )
-            end_date = end_date.replace(tzinfo=datetime.timezone.utc).timestamp() * 1e3
-            date_arg = f"&start={int(start_date)}&end={int(end_date)}"
-
-        url_historical = f"{self.BASE_URL}/{asset_id}/history?interval=d1{date_arg}"
-        url_basic_info = f"{self.BASE_URL}/{asset_id}"
-
-        hist_data, basic_info = await self.get_all_data(url_basic_info, url_historical)
-        graph_path = self.create_graph(hist_data, asset_id)
-        return (basic_info, graph_path)
-
-    async def get_all_data(self, info_url: str, historical_url: str) -> tuple:
-        # Make two requests and wait for the two of them to finish
-        # before returning the result
-        async with aiohttp.ClientSession(headers=self.headers) as session:
-            try:
-                tasks = (
-                    asyncio.ensure_future(self._get(session, historical_url)),
-                    asyncio.ensure_future(self._get(session, info_url)),
-                )
-
-                historical_data, resume_data = await asyncio.gather(*tasks)
-            except Exception:
+            for info in results:
+                self.info_cache.put(info["id"], info)
+                infos[info["id"]] = info
+            if any(infos[asset_id] is None for asset_id in missing):
                 raise FetchError()
+        return [infos[asset_id] for asset_id in asset_ids]
+
+    async def fetch_history(self, asset_id: str, start_ms: int, end_ms: int) -> tuple:
+        """
+        returns:
+            tuple: (times_ms, prices, key), key identifies the range and version
+            of the data
+        """
+        interval = self.pick_interval(start_ms, end_ms)
+        if interval == "d1":
+            # Only the ranges that are not in the local store are fetched
+            history = None
+            missing = self.price_store.missing_ranges(asset_id, start_ms, end_ms)
+        else:
+            history = self.history_cache.get((asset_id, interval, start_ms, end_ms))
+            missing = [] if history is not None else [[start_ms, end_ms]]
+        urls = [
+            f"{self.BASE_URL}/{asset_id}/history?interval={interval}"
+            f"&start={start}&end={end}"
+            for start, end in missing
+        ]
+        results = await self.get_all_data(*urls)
+
+        if interval == "d1":
+            for (start, end), candles in zip(missing, results):
+                self.price_store.add(asset_id, start, end, candles)
+            times, prices = self.price_store.get_arrays(asset_id, start_ms, end_ms)
+            version = self.price_store.version(asset_id)
+        else:
+            if history is None:
+                history = self._to_arrays(results[0]) + (time.monotonic(),)
+                self.history_cache.put((asset_id, interval, start_ms, end_ms), history)
+            times, prices, version = history
+
+        return times, prices, (asset_id, interval, start_ms, end_ms, version)
 
-        return (historical_data, resume_data)
+    async def fetch_data(
+        self, ticker: str, start_date: datetime = None, end_date: datetime = None
+    ) -> tuple:
+        asset_id = self.asset_id(ticker)
+        start_ms, end_ms = self.time_range(start_date, end_date)
+
+        (basic_info,), (times, prices, key) = await asyncio.gather(
+            self.fetch_info(asset_id), self.fetch_history(asset_id, start_ms, end_ms)
+        )
+        graph = await self.create_graph(asset_id, times, prices, key)
+        return (basic_info, graph)
 
-    async def _get(self, session, url: str) -> dict:
-        async with session.get(url) as resp:
-            if resp.status != 200:
-                raise Exception(f"Error fetching data from {url}")
+    async def fetch_comparison(
+        self, tickers: list, start_date: datetime = None, end_date: datetime = None
+    ) -> tuple:
+        """
+        Fetches several assets at once and plots their returns on a single chart.
+
+        returns:
+            tuple: (basic_infos, image_bytes), basic info of each ticker in order
+        """
+        # dict.fromkeys drops repeated tickers and keeps the order
+        asset_ids = list(dict.fromkeys(self.asset_id(ticker) for ticker in tickers))
+        start_ms, end_ms = self.time_range(start_date, end_date)
+
+        basic_infos, *histories = await asyncio.gather(
+            self.fetch_info(*asset_ids),
+            *(self.fetch_history(asset_id, start_ms, end_ms) for asset_id in asset_ids),
+        )
+        series = [
+            (asset_id, times, prices)
+            for asset_id, (times, prices, _) in zip(asset_ids, histories)
+        ]
+        key = tuple(key for _, _, key in histories)
+        graph = await self.create_comparison_graph(series, key)
+        return (basic_infos, graph)
 
-            resp = await resp.json()
-            if "error" in resp:
-                raise Exception(resp["error"])
-            return resp["data"]
+    async def get_all_data(self, *urls: str) -> tuple:
+        # Make all the requests and wait for all of them to finish
+        # before returning the results (in the same order as the urls)
+        if not urls:
+            return ()
+
+        try:
+            tasks = [asyncio.ensure_future(self._get(url)) for url in urls]
+            results = await asyncio.gather(*tasks)
+        except Exception:
+            raise FetchError()
+
+        return tuple(results)
+
+    def _to_arrays(self, candles: list) -> tuple:
+        """
+        returns:
+            tuple: (times_ms, prices) arrays of the candles, sorted by time
+        """
+        times = np.array([candle["time"] for candle in candles], dtype=np.int64)
+        prices = np.array([candle["priceUsd"] for candle in candles], dtype=np.float64)
+        order = np.argsort(times)
+        return times[order], prices[order]
+
+    async def _get(self, url: str) -> dict:
+        # Limits the requests at the same time, multi asset commands fetch a lot
+        async with self.request_semaphore:
+            async with self.http_client.get("coincap", url) as resp:
+                if resp.status != 200:
+                    raise Exception(f"Error fetching data from {url}")
+
+                resp = await resp.json()
+                if "error" in resp:
+                    raise Exception(resp["error"])
+                return resp["data"]
 
 
 if __name__ == "__main__":
-    api_inter = ApiInterface("")
-    asyncio.run(
-        api_inter.fetch_data(
+
+    async def main():
+        http_client = HttpClient()
+        api_inter = ApiInterface("", http_client)
+        await api_inter.fetch_data(
             "bitcoin", datetime.datetime(2020, 1, 1), datetime.datetime(2020, 12, 31)
         )
-    )
+        await http_client.close()
+
+    asyncio.run(main())
@@ -16,3 +16,10 @@ class FetchError(Exception):
             Tip: Check if the crypto existed in the given date range.
             """
         )
+
+
+class QueueFull(Exception):
+    def __init__(self, max_size: int):
+        super().__init__(
+            f"The generation queue is full ({max_size} requests), please try again later."
+        )
@@ -0,0 +1,53 @@
+import numpy as np
+import plotly.graph_objects as go
+
+
+def render_price_chart(times_ms: np.ndarray, prices: np.ndarray, title: str) -> bytes:
+    """
+    Renders the price chart as png bytes, nothing is written to disk.
+
+    Parameters:
+        :times_ms: Unix timestamps in milliseconds.
+        :prices: Price in USD of each timestamp.
+    """
+    x = np.asarray(times_ms, dtype=np.int64).astype("datetime64[ms]")
+    fig = go.Figure(data=go.Scatter(x=x, y=prices))
+
+    _apply_layout(fig, title, "Price [USD]")
+    return fig.to_image(format="png", width=800, height=600, scale=3)
+
+
+def render_comparison_chart(series: list, title: str) -> bytes:
+    """
+    Renders the return (in percent, since the first point) of each asset on a
+    single png chart, so assets with very different prices can be compared.
+
+    Parameters:
+        :series: [(name, times_ms, prices), ...] of each asset.
+    """
+    fig = go.Figure()
+    for name, times_ms, prices in series:
+        prices = np.asarray(prices, dtype=np.float64)
+        if len(prices) == 0 or prices[0] == 0:
+            continue
+        x = np.asarray(times_ms, dtype=np.int64).astype("datetime64[ms]")
+        fig.add_trace(go.Scatter(x=x, y=(prices / prices[0] - 1) * 100, name=name))
+
+    _apply_layout(fig, title, "Return [%]")
+    return fig.to_image(format="png", width=800, height=600, scale=3)
+
+
+def _apply_layout(fig: go.Figure, title: str, yaxis_title: str) -> None:
+    fig.update_layout(
+        title=title,
+        xaxis_title="Date",
+        yaxis_title=yaxis_title,
+        title_x=0.5,
+        template="plotly_dark",
+        plot_bgcolor="black",
+        paper_bgcolor="black",
+        font=dict(color="white"),
+        xaxis=dict(gridcolor="gray"),
+        yaxis=dict(gridcolor="gray"),
+        margin=dict(l=70, r=30, t=50, b=50),
+    )
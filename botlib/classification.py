@@ -0,0 +1,119 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from .text_analysis import AnalyzedText
+
+
+class ClassificationService:
+    """
+    Classifies the negativity of the pages in small batches while they are crawled,
+    instead of the whole crawl at once after it finishes.
+
+    The pages are truncated to the part the classifier actually reads (its
+    vectorization keeps the first 256 tokens) and grouped by length, so each batch
+    has pages of similar size. A batch is classified by the worker thread as soon
+    as it is full, the rest are classified when the results are requested.
+    """
+
+    # Twice the tokens the classifier reads, words made only of punctuation are
+    # dropped by its vectorization
+    MAX_WORDS = 512
+    # Upper bound (in words) of each length bucket
+    BUCKETS = (64, 128, 256, MAX_WORDS)
+
+    def __init__(self, nlp_tools, batch_size: int = 16) -> None:
+        self.nlp_tools = nlp_tools
+        self.batch_size = batch_size
+        self.executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="classification"
+        )
+        self.docs = 0
+        self.batches = 0
+        self.busy_time = 0.0
+        # Inference time of the last batches, in seconds
+        self.latencies = deque(maxlen=256)
+        self._lock = threading.Lock()
+
+    def start_job(self) -> "ClassificationJob":
+        """Must be called from the event loop, the batches run on its executor"""
+        return ClassificationJob(self)
+
+    def truncate(self, document: AnalyzedText) -> str:
+        return " ".join(document.words[: self.MAX_WORDS])
+
+    def classify_batch(self, texts: list) -> list:
+        start = time.perf_counter()
+        negative_amounts = self.nlp_tools.get_negative_amount_texts(texts)
+        latency = time.perf_counter() - start
+        with self._lock:
+            self.docs += len(texts)
+            self.batches += 1
+            self.busy_time += latency
+            self.latencies.append(latency)
+        return negative_amounts
+
+    def stats(self) -> dict:
+        with self._lock:
+            latencies = np.array(self.latencies)
+            docs, batches, busy_time = self.docs, self.batches, self.busy_time
+        return {
+            "docs": docs,
+            "batches": batches,
+            "docs_per_second": docs / busy_time if busy_time else 0.0,
+            "mean_latency": float(latencies.mean()) if len(latencies) else 0.0,
+            "p95_latency": (
+                float(np.percentile(latencies, 95)) if len(latencies) else 0.0
+            ),
+        }
+
+
+class ClassificationJob:
+    """
+    Pages of a single crawl, add them as they are fetched and await results()
+    once the crawl is done.
+    """
+
+    def __init__(self, service: ClassificationService) -> None:
+        self.service = service
+        self.n_docs = 0
+        # Bucket -> [(position, truncated text)] waiting for a full batch
+        self._buckets = {bound: [] for bound in service.BUCKETS}
+        self._batches = []
+
+    def add(self, document: AnalyzedText) -> None:
+        text = self.service.truncate(document)
+        n_words = min(len(document.words), self.service.MAX_WORDS)
+        bound = next(b for b in self.service.BUCKETS if n_words <= b)
+        bucket = self._buckets[bound]
+        bucket.append((self.n_docs, text))
+        self.n_docs += 1
+        if len(bucket) >= self.service.batch_size:
+            self._submit(bucket)
+            self._buckets[bound] = []
+
+    async def results(self) -> list:
+        """
+        returns:
+            list: the negative amount of each page, in the order they were added
+        """
+        for bound, bucket in self._buckets.items():
+            if bucket:
+                self._submit(bucket)
+                self._buckets[bound] = []
+
+        negative_amounts = [0.0] * self.n_docs
+        for positions, future in self._batches:
+            for position, negative_amount in zip(positions, await future):
+                negative_amounts[position] = negative_amount
+        self._batches = []
+        return negative_amounts
+
+    def _submit(self, bucket: list) -> None:
+        positions, texts = zip(*bucket)
+        future = asyncio.get_running_loop().run_in_executor(
+            self.service.executor, self.service.classify_batch, list(texts)
+        )
+        self._batches.append((positions, future))
@@ -7,67 +7,213 @@ from keras.layers import (
     Embedding,
     LSTM,
 )
-from transformers import pipeline, set_seed
 import os
+import threading
 from keras.models import Model, load_model
 import keras
 import numpy as np
 import tensorflow as tf
+from .lazy_loader import LazyLoader
+from .tflite_models import TFLiteModel
 
-N_NOT_REPEATED_TRIALS = 50
+# Candidates the next word is sampled from
+TOP_K = 10
 
 
 class ContentGenerator:
+    MODEL_PATH = "models/CONTENT_GENERATOR"
+    # Vocabulary of the vectorization layer, saved when it is adapted
+    VOCABULARY_PATH = "models/vocabulary.npz"
+    VOCABULARY_VERSION = 1
+    # Quantized export of the predictor (manager_script.py export), used for the
+    # generation while it is up to date with MODEL_PATH
+    TFLITE_PATH = "models/content_generator.tflite"
+
     def __init__(self, vocab_size=5_000, n_grams=10, n_training_epochs=20) -> None:
         self.vocab_size = vocab_size
-        self.vectorize_layer = TextVectorization(
-            max_tokens=vocab_size, output_sequence_length=n_grams
-        )
+        self.n_grams = n_grams
         self.n_training_epochs = n_training_epochs
+        # Texts the vocabulary is adapted on when the layer is first used,
+        # set by the TrainingScheduler (a callable returning the texts, or None)
+        self.vocabulary_texts = None
+
+        # The models are only loaded when they are first used
+        self._vectorize_layer = LazyLoader("vectorization", self._load_vectorization)
+        self._predictor = LazyLoader("content generator", self._load_predictor)
+        self._gpt_generator = LazyLoader("gpt2 pipeline", self._load_gpt_generator)
+        # Built on the first generation, see _decode_step
+        self._vocabulary = None
+        self._decode_fn = None
+
+    @property
+    def vectorize_layer(self) -> TextVectorization:
+        return self._vectorize_layer.get()
+
+    @property
+    def predictor(self) -> Model:
+        return self._predictor.get()
+
+    @property
+    def gpt_generator(self):
+        return self._gpt_generator.get()
 
-        if os.path.exists("models/CONTENT_GENERATOR"):
-            print("[INFO] Loading content generator...")
-            self.predictor = load_model("models/CONTENT_GENERATOR")
+    @property
+    def vocabulary(self) -> np.ndarray:
+        """Words of the vectorization layer, indexed by token id"""
+        if self._vocabulary is None:
+            self._vocabulary = np.array(self.vectorize_layer.get_vocabulary())
+        return self._vocabulary
+
+    def _load_vectorization(self) -> TextVectorization:
+        vectorize_layer = TextVectorization(
+            max_tokens=self.vocab_size, output_sequence_length=self.n_grams
+        )
+        texts = self.vocabulary_texts() if self.vocabulary_texts else None
+        if not texts:
+            return vectorize_layer
+
+        vocabulary = self.load_vocabulary(len(texts))
+        if vocabulary is not None:
+            vectorize_layer.set_vocabulary(vocabulary)
         else:
-            self.build_model()
+            # No saved vocabulary (or an outdated one), adapted once and saved
+            vectorize_layer.adapt(self.text_dataset(texts).batch(64))
+            self.save_vocabulary(vectorize_layer, len(texts))
+        return vectorize_layer
+
+    def load_vocabulary(self, n_docs: int) -> list:
+        """
+        returns:
+            list: the saved vocabulary, None if there is none or it was not
+            adapted on the first n_docs documents
+        """
+        if not os.path.exists(self.VOCABULARY_PATH):
+            return None
+        with np.load(self.VOCABULARY_PATH) as data:
+            if (
+                int(data["version"]) != self.VOCABULARY_VERSION
+                or int(data["n_docs"]) != n_docs
+            ):
+                return None
+            return data["vocabulary"].tolist()
+
+    def save_vocabulary(self, vectorize_layer: TextVectorization, n_docs: int) -> None:
+        tmp_path = self.VOCABULARY_PATH + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                vocabulary=np.array(vectorize_layer.get_vocabulary()),
+                n_docs=np.int64(n_docs),
+                version=np.int64(self.VOCABULARY_VERSION),
+            )
+        os.replace(tmp_path, self.VOCABULARY_PATH)
+
+    def _load_predictor(self) -> Model:
+        if os.path.exists(self.MODEL_PATH):
+            return load_model(self.MODEL_PATH)
+        return self.build_model()
+
+    def _load_gpt_generator(self):
+        # Importing transformers alone takes seconds, only done if gpt is used
+        from transformers import pipeline, set_seed
 
         set_seed(42)
-        self.gpt_generator = pipeline("text-generation", model="gpt2")
+        generator = pipeline("text-generation", model="gpt2")
+        # Needed to batch prompts of different lengths, gpt2 has no padding token
+        # and generates after the last token of the prompt
+        generator.tokenizer.pad_token_id = generator.model.config.eos_token_id
+        generator.tokenizer.padding_side = "left"
+        return generator
 
-    def build_model(self):
-        self.predictor, latent = self._predict_word_model(10, 15, self.vocab_size)
+    def build_model(self) -> Model:
+        predictor, latent = self._predict_word_model(10, 15, self.vocab_size)
         opt = keras.optimizers.Nadam(learning_rate=0.1)
         loss_fn = keras.losses.SparseCategoricalCrossentropy(
             ignore_class=1,
             name="sparse_categorical_crossentropy",
         )
-        self.predictor.compile(loss=loss_fn, optimizer=opt, metrics=["accuracy"])
-        print(self.predictor.summary())
+        predictor.compile(loss=loss_fn, optimizer=opt, metrics=["accuracy"])
+        print(predictor.summary())
+        return predictor
 
-    def get_last_token(self, x):
-        """
-        Function to map the dataset to (x, y) pairs.
+    def warm_up(self, gpt: bool = False) -> None:
+        """Loads the models now instead of on their first use"""
+        self.vectorize_layer
+        self._decode_step()
+        if gpt:
+            self.gpt_generator
 
-        Y is last token of X.
-        X is output of vectorization minus the last token.
+    def text_dataset(self, texts):
+        """
+        Streams the texts from any iterable (e.g. the lazy contents of the Scraper),
+        so the whole corpus never has to be loaded in memory.
         """
-        vectorized = self.vectorize_layer(x)
-        x_ = vectorized[:, :-1]
-        y_ = vectorized[:, -1:]
-        return x_, y_
+        return tf.data.Dataset.from_generator(
+            lambda: iter(texts),
+            output_signature=tf.TensorSpec(shape=(), dtype=tf.string),
+        )
 
     def adapt_vectorization(self, dataset):
-        self.vectorize_layer.adapt(dataset)
+        """Adapts the vocabulary on the texts (a sized iterable) and saves it"""
+        self.vectorize_layer.adapt(self.text_dataset(dataset).batch(64))
+        self._vocabulary = None
+        self.save_vocabulary(self.vectorize_layer, len(dataset))
+
+    def extend_vocabulary(self, texts, n_docs: int) -> int:
+        """
+        Appends the most frequent words of the texts that are not in the vocabulary
+        to its unused slots (up to vocab_size) and saves it, the ids of the words
+        already in it don't change.
+
+        Parameters:
+            :n_docs: Number of documents the vocabulary is now built from.
+
+        returns:
+            int: number of words added
+        """
+        vocabulary = self.vectorize_layer.get_vocabulary()
+        free_slots = self.vocab_size - len(vocabulary)
+        if free_slots <= 0:
+            return 0
 
-    def train(self, dataset):
-        train_dataset = tf.data.Dataset.from_tensor_slices(dataset).batch(64)
-        train_dataset = train_dataset.map(self.get_last_token)
+        # Sorted by decreasing frequency, the mask and [UNK] tokens first
+        counter = TextVectorization(max_tokens=self.vocab_size)
+        counter.adapt(self.text_dataset(texts).batch(64))
+        known = set(vocabulary)
+        new_words = [word for word in counter.get_vocabulary()[2:] if word not in known]
+        new_words = new_words[:free_slots]
+        if new_words:
+            self.vectorize_layer.set_vocabulary(vocabulary + new_words)
+            self._vocabulary = None
+        self.save_vocabulary(self.vectorize_layer, n_docs)
+        return len(new_words)
 
-        self.predictor.fit(train_dataset, epochs=self.n_training_epochs)
-        self.predictor.save("models/CONTENT_GENERATOR")
+    def train_ids(self, token_ids: np.ndarray, epochs=None):
+        """
+        Trains the current model (the last checkpoint, if one was loaded) on the
+        token ids of the texts (see vectorize_texts) and saves it, the texts are not
+        vectorized again on every epoch. Uses n_training_epochs if epochs is not given.
+        """
+        train_dataset = tf.data.Dataset.from_tensor_slices(token_ids).batch(64)
+        train_dataset = train_dataset.map(lambda ids: (ids[:, :-1], ids[:, -1:]))
+        self._fit(train_dataset, epochs)
+
+    def vectorize_texts(self, texts) -> np.ndarray:
+        """
+        returns:
+            np.ndarray: (len(texts), n_grams) token ids of the texts
+        """
+        dataset = self.text_dataset(texts).batch(256).map(self.vectorize_layer)
+        batches = [batch.numpy().astype(np.int32) for batch in dataset]
+        if not batches:
+            return np.zeros((0, self.n_grams), dtype=np.int32)
+        return np.concatenate(batches)
 
-    def predict(self, x: str):
-        return self.predictor.predict(self.vectorize_layer([x])[:, 1:])
+    def _fit(self, train_dataset, epochs=None):
+        self.predictor.fit(train_dataset, epochs=epochs or self.n_training_epochs)
+        self.predictor.save(self.MODEL_PATH)
+        # The TFLite export (if any) is outdated now, it falls back to the predictor
+        self._decode_fn = None
 
     def _predict_word_model(self, seq_len, latent_dim, vocab_size):
         input_layer = Input(shape=(seq_len - 1,))
@@ -80,37 +226,111 @@ class ContentGenerator:
         x = Softmax()(x)
         return Model(input_layer, x), Model(input_layer, latent_rep)
 
+    def _decode_step(self) -> tuple:
+        """
+        Call of the predictor on a single window of token ids: the TFLite export if
+        it is up to date, otherwise a compiled call of the Keras model. Both avoid
+        the overhead of predict (a dataset and a loop per call) for every word.
+
+        returns:
+            tuple: (step function, dtype of the window), the step returns the
+            probabilities of the next token as a numpy array
+        """
+        if self._decode_fn is None:
+            tflite_model = TFLiteModel.load(self.TFLITE_PATH, self.MODEL_PATH)
+            if tflite_model is not None:
+                print("[INFO] Using the TFLite content generator")
+                self._decode_fn = (
+                    tflite_model.predict_on_batch,
+                    tflite_model.input_dtype,
+                )
+            else:
+                predictor = self.predictor
+                window_spec = tf.TensorSpec(
+                    shape=(1, predictor.inputs[0].shape[1]),
+                    dtype=predictor.inputs[0].dtype,
+                )
+                compiled = tf.function(
+                    lambda window: predictor(window, training=False),
+                    input_signature=[window_spec],
+                )
+                self._decode_fn = (
+                    lambda window: compiled(window).numpy(),
+                    window_spec.dtype.as_numpy_dtype,
+                )
+        return self._decode_fn
+
     def generate_content(self, pages, n_predictions=20):
-        phrase = []
-        # Sliding context
-        context = pages
-        vocabulary = self.vectorize_layer.get_vocabulary()
+        return " ".join(self.generate_content_stream(pages, n_predictions))
+
+    def generate_content_stream(self, pages, n_predictions=20):
+        """Yields the generated words one at a time"""
+        vocabulary = self.vocabulary
+        decode_step, window_dtype = self._decode_step()
+
+        # Sliding context, the token ids of the page (without the first one, as in
+        # training) and then of the generated words
+        window = self.vectorize_layer([pages])[0, 1:].numpy()
+        window = window.astype(window_dtype)[None, :]
+        # Token ids that can't be chosen: out of the vocabulary or already generated
+        banned = np.zeros(self.vocab_size, dtype=bool)
+        banned[len(vocabulary) :] = True
+
         for _ in range(n_predictions):
-            pred = self.predict(context)
-            word = ""
-            for _ in range(N_NOT_REPEATED_TRIALS):
-                # Select k-best (10)
-                k_best_predictions = tf.math.top_k(pred, k=10).indices[0, :]
-                top_idxs = k_best_predictions.numpy()
-                idx = np.random.choice(top_idxs)
-
-                if idx > len(vocabulary) - 1:
-                    pred[0][idx] = 0
-                    continue
-
-                word = vocabulary[idx]
-                if word not in phrase:
-                    break
-                pred[0][idx] = 0
-
-            phrase.append(word)
-            context = context.split()[1:]
-            context.append(word)
-            context = " ".join(context)
-        return " ".join(phrase)
+            pred = decode_step(window)[0]
+            pred[banned[: len(pred)]] = -1
+            # Uniform choice between the k best
+            k_best = np.argpartition(pred, -TOP_K)[-TOP_K:]
+            k_best = k_best[pred[k_best] >= 0]
+            if len(k_best) == 0:
+                break
+            idx = np.random.choice(k_best)
+
+            banned[idx] = True
+            window[0, :-1] = window[0, 1:]
+            window[0, -1] = idx
+            yield str(vocabulary[idx])
 
     def gpt_generate(self, page):
-        prompt = f"Generate a content for this page: \n" + page[:500]
-        res = self.gpt_generator(prompt, max_new_tokens=50)
+        return self.gpt_generate_batch([page])[0]
+
+    def _gpt_prompt(self, page: str) -> str:
+        return f"Generate a content for this page: \n" + page[:500]
+
+    def gpt_generate_batch(self, pages: list) -> list:
+        """Generates the content of several pages in a single forward pass"""
+        prompts = [self._gpt_prompt(page) for page in pages]
+        results = self.gpt_generator(
+            prompts, max_new_tokens=50, batch_size=len(prompts)
+        )
         # Returns only the generated text, without the prompt
-        return "\n".join(res[0]["generated_text"].split("\n")[1:])
+        return ["\n".join(res[0]["generated_text"].split("\n")[1:]) for res in results]
+
+    def gpt_generate_stream(self, page, timeout: float = 60):
+        """
+        Yields the same text as gpt_generate in chunks, as the tokens are generated.
+
+        Parameters:
+            :timeout: Seconds without a new token before giving up.
+        """
+        from transformers import TextIteratorStreamer
+
+        generator = self.gpt_generator
+        streamer = TextIteratorStreamer(
+            generator.tokenizer,
+            skip_prompt=True,
+            skip_special_tokens=True,
+            timeout=timeout,
+        )
+        # The pipeline pushes the tokens to the streamer while it generates
+        thread = threading.Thread(
+            target=generator,
+            args=(self._gpt_prompt(page),),
+            kwargs={"max_new_tokens": 50, "streamer": streamer},
+            daemon=True,
+        )
+        thread.start()
+        # The prompt without its first line, as gpt_generate returns it
+        yield page[:500]
+        yield from streamer
+        thread.join()
@@ -0,0 +1,119 @@
+import functools
+import json
+import os
+import numpy as np
+
+
+class DocumentStore:
+    """
+    Append-only store for the crawled pages.
+
+    Files:
+        contents.seg: utf-8 contents of every page, one after the other
+        offsets.bin:  (offset, length) int64 pair of each page in contents.seg
+        meta.jsonl:   one {"url", "title"} line per page
+
+    Only the urls, titles and offsets are kept in memory, the contents are read
+    from disk by doc_id through a small LRU cache.
+    """
+
+    def __init__(self, path: str, cache_size: int = 32) -> None:
+        self.path = path
+        self.contents_path = os.path.join(path, "contents.seg")
+        self.offsets_path = os.path.join(path, "offsets.bin")
+        self.meta_path = os.path.join(path, "meta.jsonl")
+        os.makedirs(path, exist_ok=True)
+
+        self.urls: list = []
+        self.titles: list = []
+        # Size of meta.jsonl after each line, to truncate it
+        meta_ends = [0]
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, "rb") as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        # Partially written line
+                        break
+                    meta = json.loads(line)
+                    self.urls.append(meta["url"])
+                    self.titles.append(meta["title"])
+                    meta_ends.append(meta_ends[-1] + len(line))
+
+        if os.path.exists(self.offsets_path):
+            self.offsets = np.fromfile(self.offsets_path, dtype=np.int64)
+            self.offsets = self.offsets[: len(self.offsets) // 2 * 2]
+            self.offsets = self.offsets.reshape(-1, 2).tolist()
+        else:
+            self.offsets = []
+
+        # A crash in the middle of an append can leave one of the files longer, the
+        # extra rows are removed so the next append is aligned in every file
+        n_docs = min(len(self.urls), len(self.offsets))
+        self.urls, self.titles = self.urls[:n_docs], self.titles[:n_docs]
+        self.offsets = self.offsets[:n_docs]
+        contents_end = sum(self.offsets[-1]) if n_docs else 0
+        self._truncate(self.meta_path, meta_ends[n_docs])
+        self._truncate(self.offsets_path, n_docs * 2 * 8)
+        self._truncate(self.contents_path, contents_end)
+
+        self._read_content = functools.lru_cache(maxsize=cache_size)(self._read)
+        self.contents = _ContentsView(self)
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def append(self, url: str, title: str, content: str) -> int:
+        data = content.encode("utf-8")
+        with open(self.contents_path, "ab") as f:
+            offset = f.tell()
+            f.write(data)
+        with open(self.offsets_path, "ab") as f:
+            f.write(np.array([offset, len(data)], dtype=np.int64).tobytes())
+        with open(self.meta_path, "a") as f:
+            f.write(json.dumps({"url": url, "title": title}) + "\n")
+
+        self.offsets.append([offset, len(data)])
+        self.urls.append(url)
+        self.titles.append(title)
+        return len(self.offsets) - 1
+
+    def get_content(self, doc_id: int) -> str:
+        if doc_id < 0 or doc_id >= len(self):
+            raise IndexError(f"Document {doc_id} is not in the store")
+        return self._read_content(doc_id)
+
+    def iter_contents(self):
+        """Reads every content sequentially, bypassing the cache"""
+        if not self.offsets:
+            return
+        with open(self.contents_path, "rb") as f:
+            for offset, length in self.offsets:
+                f.seek(offset)
+                yield f.read(length).decode("utf-8")
+
+    def _truncate(self, path: str, size: int) -> None:
+        if os.path.exists(path) and os.path.getsize(path) > size:
+            print(f"[INFO] Removing a partially written document from {path}")
+            os.truncate(path, size)
+
+    def _read(self, doc_id: int) -> str:
+        offset, length = self.offsets[doc_id]
+        with open(self.contents_path, "rb") as f:
+            f.seek(offset)
+            return f.read(length).decode("utf-8")
+
+
+class _ContentsView:
+    """Read-only list-like access to the contents of a DocumentStore"""
+
+    def __init__(self, store: DocumentStore) -> None:
+        self.store = store
+
+    def __len__(self) -> int:
+        return len(self.store)
+
+    def __getitem__(self, doc_id: int) -> str:
+        return self.store.get_content(doc_id)
+
+    def __iter__(self):
+        return self.store.iter_contents()
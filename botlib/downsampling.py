@@ -0,0 +1,40 @@
+import numpy as np
+
+
+def lttb(x: np.ndarray, y: np.ndarray, n_out: int) -> tuple:
+    """
+    Largest-Triangle-Three-Buckets downsampling, keeps the visual shape of a series
+    (peaks and valleys) with only n_out points. The first and last points are kept.
+
+    returns:
+        tuple: (x, y) arrays with at most n_out points
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return x, y
+
+    x_f = np.asarray(x, dtype=np.float64)
+    y_f = np.asarray(y, dtype=np.float64)
+    every = (n - 2) / (n_out - 2)
+    # Bucket i is [edges[i], edges[i + 1]), the first and last points have their own
+    edges = np.minimum(np.floor(np.arange(n_out) * every).astype(np.int64) + 1, n)
+
+    selected = np.empty(n_out, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        next_start, next_end = edges[i + 1], max(edges[i + 2], edges[i + 1] + 1)
+        avg_x = x_f[next_start:next_end].mean()
+        avg_y = y_f[next_start:next_end].mean()
+
+        # Double of the area of the triangles (a, point, average of the next bucket)
+        area = np.abs(
+            (x_f[a] - avg_x) * (y_f[start:end] - y_f[a])
+            - (x_f[a] - x_f[start:end]) * (avg_y - y_f[a])
+        )
+        a = start + int(np.argmax(area))
+        selected[i + 1] = a
+
+    return x[selected], y[selected]
@@ -0,0 +1,178 @@
+import asyncio
+import math
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from .bot_exceptions import QueueFull
+from .streaming import stream_in_executor
+
+
+class GenerationScheduler:
+    """
+    Queue of generation requests (e.g. GPT-2), shared by every user of the bot.
+
+    The requests are processed by max_concurrency workers, each one takes the
+    requests that arrive within max_wait seconds of each other (up to
+    max_batch_size) and generates them with a single call of generate_batch,
+    which runs in a thread so the event loop keeps answering. The queue is
+    bounded, new requests are refused with QueueFull when it is full.
+
+    Streamed requests (see generate_stream) are batched like the others, their
+    text is only delivered in chunks while it is generated when the batch has no
+    other request (the queue was idle), under load it arrives as a single chunk
+    when the batch finishes.
+    """
+
+    def __init__(
+        self,
+        generate_batch,
+        generate_stream=None,
+        max_queue_size: int = 16,
+        max_batch_size: int = 4,
+        max_wait: float = 0.1,
+        max_concurrency: int = 1,
+    ) -> None:
+        """
+        Parameters:
+            :generate_batch: Function that receives a list of prompts and returns
+                the list of generated texts, in the same order.
+            :generate_stream: Optional generator function that receives a prompt and
+                yields its generated text in chunks.
+        """
+        self.generate_batch = generate_batch
+        self.generate_stream = generate_stream
+        self.max_queue_size = max_queue_size
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_concurrency = max_concurrency
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_concurrency, thread_name_prefix="generation"
+        )
+        self.queue = None
+        self.workers = []
+        # Requests taken by the workers and not finished yet
+        self.running = 0
+        # Duration of the last batches, in seconds, used for the estimates
+        self.batch_times = deque(maxlen=32)
+
+    async def submit(self, prompt: str, stream: bool = False) -> tuple:
+        """
+        Queues the prompt to be generated.
+
+        Parameters:
+            :stream: Returns an async iterator of the chunks of the text instead
+                of a future, requires generate_stream.
+
+        returns:
+            tuple: (asyncio.Future with the generated text, position in the queue
+            (1 is the next one), estimated seconds until it is done)
+        """
+        if not self.workers:
+            # Created here, they must belong to the running event loop
+            self.queue = asyncio.Queue(maxsize=self.max_queue_size)
+            self.workers = [
+                asyncio.create_task(self._work()) for _ in range(self.max_concurrency)
+            ]
+
+        future = asyncio.get_running_loop().create_future()
+        chunks = asyncio.Queue() if stream else None
+        try:
+            self.queue.put_nowait((prompt, future, chunks))
+        except asyncio.QueueFull:
+            raise QueueFull(self.max_queue_size)
+
+        position = self.queue.qsize()
+        if stream:
+            return self._iter_chunks(chunks, future), position, self.estimate(position)
+        return future, position, self.estimate(position)
+
+    def estimate(self, position: int) -> float:
+        """Seconds until the request at that position of the queue is done"""
+        batch_time = (
+            sum(self.batch_times) / len(self.batch_times) if self.batch_times else 0.0
+        )
+        n_batches = math.ceil(position / self.max_batch_size)
+        n_batches = math.ceil(n_batches / self.max_concurrency)
+        if self.running:
+            # The batch being generated has to finish first
+            n_batches += 1
+        return n_batches * batch_time
+
+    def stats(self) -> dict:
+        return {
+            "queued": self.queue.qsize() if self.queue is not None else 0,
+            "running": self.running,
+            "batches": len(self.batch_times),
+            "mean_batch_time": (
+                sum(self.batch_times) / len(self.batch_times)
+                if self.batch_times
+                else 0.0
+            ),
+        }
+
+    async def _iter_chunks(self, chunks: asyncio.Queue, future: asyncio.Future):
+        while True:
+            chunk = await chunks.get()
+            if chunk is None:
+                break
+            yield chunk
+        # Raises the exception of the generation, if any
+        await future
+
+    async def _next_batch(self) -> list:
+        batch = [await self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _work(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            self.running += len(batch)
+            start = time.perf_counter()
+            try:
+                if len(batch) == 1 and batch[0][2] is not None:
+                    results = [await self._stream(*batch[0])]
+                else:
+                    prompts = [prompt for prompt, _, _ in batch]
+                    results = await loop.run_in_executor(
+                        self.executor, self.generate_batch, prompts
+                    )
+                    # The streamed requests of a batch get their text at once
+                    for (_, _, chunks), result in zip(batch, results):
+                        if chunks is not None:
+                            chunks.put_nowait(result)
+                for (_, future, _), result in zip(batch, results):
+                    if not future.done():
+                        future.set_result(result)
+            except Exception as e:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            finally:
+                for _, _, chunks in batch:
+                    if chunks is not None:
+                        chunks.put_nowait(None)
+                self.batch_times.append(time.perf_counter() - start)
+                self.running -= len(batch)
+                for _ in batch:
+                    self.queue.task_done()
+
+    async def _stream(
+        self, prompt: str, future: asyncio.Future, chunks: asyncio.Queue
+    ) -> str:
+        text = []
+        async for chunk in stream_in_executor(
+            self.executor, self.generate_stream, prompt
+        ):
+            text.append(chunk)
+            chunks.put_nowait(chunk)
+        return "".join(text)
@@ -0,0 +1,85 @@
+import aiohttp
+
+
+class HttpClient:
+    """
+    aiohttp session shared by the whole bot (ApiInterface and Scraper), so the
+    connections (and DNS lookups) are reused between commands.
+
+    Each service is registered with its own headers and timeout, which are applied
+    to its requests. The session is created on the first request, it must belong
+    to the running event loop, and must be closed with close() on shutdown.
+    """
+
+    def __init__(
+        self,
+        limit: int = 100,
+        limit_per_host: int = 10,
+        keepalive_timeout: float = 30,
+        dns_cache_ttl: int = 300,
+    ) -> None:
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.services: dict = {}
+        self.requests = 0
+        self.connections_created = 0
+        self.connections_reused = 0
+        self._session = None
+
+    def register(self, service: str, headers: dict = None, timeout: float = None):
+        self.services[service] = {
+            "headers": headers or {},
+            "timeout": aiohttp.ClientTimeout(total=timeout),
+        }
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=self.dns_cache_ttl,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector, trace_configs=[self._trace_config()]
+            )
+        return self._session
+
+    def get(self, service: str, url: str, **kwargs):
+        """Same as aiohttp's session.get, with the headers and timeout of the service"""
+        config = self.services[service]
+        headers = {**config["headers"], **kwargs.pop("headers", {})}
+        kwargs.setdefault("timeout", config["timeout"])
+        return self.session.get(url, headers=headers, **kwargs)
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    def stats(self) -> dict:
+        connections = self.connections_created + self.connections_reused
+        return {
+            "requests": self.requests,
+            "connections_created": self.connections_created,
+            "connections_reused": self.connections_reused,
+            "reuse_rate": self.connections_reused / connections if connections else 0.0,
+        }
+
+    def _trace_config(self) -> aiohttp.TraceConfig:
+        async def on_request_start(session, context, params):
+            self.requests += 1
+
+        async def on_connection_create_end(session, context, params):
+            self.connections_created += 1
+
+        async def on_connection_reuseconn(session, context, params):
+            self.connections_reused += 1
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+        return trace_config
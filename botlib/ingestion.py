@@ -0,0 +1,169 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from .classification import ClassificationService
+
+
+class IngestionPipeline:
+    """
+    Runs the CPU bound part of a crawl (classification, indexing and training)
+    outside of the event loop. The content generator is only trained when the
+    TrainingScheduler decides to, in the background on its own thread, so the
+    next crawls are indexed while it trains. A single training runs at a time.
+
+    Jobs are queued and processed one at a time by a single worker thread, the
+    models and the index are shared so running two jobs at once would not be
+    faster. A thread is used instead of a process because the models and the
+    index live in this process (TensorFlow and numpy release the GIL while working).
+    """
+
+    def __init__(self, nlp_tools) -> None:
+        self.nlp_tools = nlp_tools
+        # Pages can be classified while they are crawled, before the job is queued
+        self.classification = ClassificationService(nlp_tools)
+        self.executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="ingestion"
+        )
+        self.training_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="training"
+        )
+        # The running training, if any
+        self.training = None
+        self.queue = None
+        self.worker = None
+        # Queued jobs plus the one being processed
+        self.pending_jobs = 0
+
+    async def submit(
+        self, documents: list, doc_ids: list, report=None, negative_amounts: list = None
+    ) -> asyncio.Future:
+        """
+        Queues the documents to be ingested.
+
+        Parameters:
+            :documents: The analyzed pages (see TextAnalyzer).
+            :doc_ids: Id of each page in the DocumentStore, the index uses the same ids.
+            :report: Optional coroutine function called with progress messages.
+            :negative_amounts: Negative amount of each page, if they were already
+                classified (see ClassificationService), otherwise they are classified here.
+
+        returns:
+            asyncio.Future: Resolves with the number of ingested pages.
+        """
+        if self.worker is None:
+            # Created here, they must belong to the running event loop
+            self.queue = asyncio.Queue()
+            self.worker = asyncio.create_task(self._work())
+
+        future = asyncio.get_running_loop().create_future()
+        self.pending_jobs += 1
+        await self.queue.put((documents, doc_ids, report, negative_amounts, future))
+        return future
+
+    async def index_unindexed(self) -> None:
+        """
+        Ingests the stored pages that are missing from the index (see
+        NlpTools.unindexed_docs), meant to run once the bot is ready.
+        """
+        doc_ids = self.nlp_tools.unindexed_docs
+        if not doc_ids:
+            return
+        self.nlp_tools.unindexed_docs = []
+        print(f"[INFO] Indexing {len(doc_ids)} stored pages missing from the index...")
+        loop = asyncio.get_running_loop()
+        try:
+            documents = await loop.run_in_executor(
+                self.executor, self.nlp_tools.analyze_stored, doc_ids
+            )
+            job = await self.submit(documents, doc_ids)
+            await job
+        except Exception as e:
+            print(e)
+
+    async def _work(self) -> None:
+        while True:
+            documents, doc_ids, report, negative_amounts, future = (
+                await self.queue.get()
+            )
+            try:
+                future.set_result(
+                    await self._ingest(documents, doc_ids, report, negative_amounts)
+                )
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                self.pending_jobs -= 1
+                self.queue.task_done()
+
+    async def _ingest(
+        self, documents: list, doc_ids: list, report, negative_amounts: list
+    ) -> int:
+        async def progress(message):
+            print(f"[INFO] {message}")
+            if report is not None:
+                await report(message)
+
+        loop = asyncio.get_running_loop()
+        if negative_amounts is None:
+            await progress(f"Classifying {len(documents)} pages...")
+            job = self.classification.start_job()
+            for document in documents:
+                job.add(document)
+            negative_amounts = await job.results()
+
+        await progress("Indexing pages...")
+        index, synsets = await loop.run_in_executor(
+            self.executor,
+            self.nlp_tools.build_index,
+            documents,
+            doc_ids,
+            negative_amounts,
+        )
+        # Searches keep using the previous snapshot until here
+        self.nlp_tools.publish_index(index, synsets)
+        await progress("New pages are now searchable!")
+
+        self.train_if_needed(report)
+        return len(documents)
+
+    def train_if_needed(self, report=None) -> None:
+        """
+        Starts training the content generator in the background if the
+        TrainingScheduler says it is time to and no training is running.
+
+        Parameters:
+            :report: Optional coroutine function called with progress messages.
+        """
+        if self.training is not None and not self.training.done():
+            return
+        if not self.nlp_tools.training_scheduler.should_train():
+            return
+        self.training = asyncio.create_task(self._train(report))
+
+    async def _train(self, report=None) -> None:
+        async def progress(message):
+            print(f"[INFO] {message}")
+            if report is not None:
+                await report(message)
+
+        scheduler = self.nlp_tools.training_scheduler
+        try:
+            await progress(
+                f"Training the content generator on {scheduler.pending_docs} new pages..."
+            )
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(self.training_executor, scheduler.train)
+            await progress(
+                f"Content generator trained in {result['wall_time']:.1f}s "
+                f"({result['cpu_time']:.1f}s of CPU)."
+            )
+        except Exception as e:
+            print(e)
+
+    async def run_training_schedule(self, check_interval: float = 600) -> None:
+        """
+        Periodically checks the TrainingScheduler, so the pages waiting for training
+        are used even if no new crawl happens.
+        """
+        while True:
+            await asyncio.sleep(check_interval)
+            self.train_if_needed()
@@ -0,0 +1,73 @@
+import threading
+import time
+from contextlib import contextmanager
+import psutil
+
+
+class LoadReport:
+    """
+    Time and memory (RSS of the process) used to load each component of the bot.
+
+    The RSS difference is approximate, other threads may allocate memory while a
+    component is loading.
+    """
+
+    def __init__(self) -> None:
+        self.entries: dict = {}
+        self._process = psutil.Process()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def measure(self, name: str):
+        rss_start = self._process.memory_info().rss
+        start = time.perf_counter()
+        yield
+        entry = {
+            "time": time.perf_counter() - start,
+            "rss_mb": (self._process.memory_info().rss - rss_start) / 2**20,
+        }
+        with self._lock:
+            self.entries[name] = entry
+
+    def summary(self) -> str:
+        with self._lock:
+            entries = dict(self.entries)
+        lines = [
+            f"{name}: {entry['time']:.2f}s, {entry['rss_mb']:+.1f} MB"
+            for name, entry in entries.items()
+        ]
+        lines.append(f"total rss: {self._process.memory_info().rss / 2**20:.1f} MB")
+        return "\n".join(lines)
+
+
+# Shared by every component, printed once the bot is ready
+load_report = LoadReport()
+
+
+class LazyLoader:
+    """
+    Loads a resource (e.g. a model) on its first use, only once even if several
+    threads ask for it at the same time. The load is measured in the load report.
+    """
+
+    def __init__(self, name: str, load, report: LoadReport = load_report) -> None:
+        self.name = name
+        self._load = load
+        self._report = report
+        self._value = None
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded
+
+    def get(self):
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    print(f"[INFO] Loading {self.name}...")
+                    with self._report.measure(self.name):
+                        self._value = self._load()
+                    self._loaded = True
+        return self._value
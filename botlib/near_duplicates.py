@@ -0,0 +1,121 @@
+import hashlib
+import os
+import numpy as np
+
+
+class NearDuplicateIndex:
+    """
+    MinHash signatures of the stored pages, with an LSH index to find the pages
+    that share most of their content with a new one (mirrors, query string
+    variants of the same page, ...).
+
+    The signature of a page has NUM_HASHES minimums of its hashed word shingles,
+    the fraction of equal minimums between two signatures estimates the Jaccard
+    similarity of their shingles. The signatures are split in BANDS bands, pages
+    that have an equal band are candidates and are compared with THRESHOLD.
+
+    Persisted as a .npz with the signatures and their doc ids, the LSH buckets are
+    rebuilt on load.
+    """
+
+    VERSION = 1
+    SHINGLE_SIZE = 5
+    NUM_HASHES = 128
+    BANDS = 16
+    THRESHOLD = 0.8
+    SEED = 42
+    # Shingles hashed at once, bounds the memory used by long pages
+    CHUNK_SIZE = 4096
+
+    def __init__(self, path: str = "data/near_duplicates.npz") -> None:
+        self.path = path
+        rng = np.random.default_rng(self.SEED)
+        # Multiply-shift hash functions, the products wrap around 2**64
+        self._a = rng.integers(1, 2**63, size=self.NUM_HASHES, dtype=np.uint64) | 1
+        self._b = rng.integers(0, 2**63, size=self.NUM_HASHES, dtype=np.uint64)
+        self.doc_ids: list = []
+        self.signatures: list = []
+        self._buckets = [dict() for _ in range(self.BANDS)]
+        self._changed = False
+
+        if os.path.exists(path):
+            with np.load(path) as data:
+                if int(data["version"]) == self.VERSION:
+                    for doc_id, signature in zip(data["doc_ids"], data["signatures"]):
+                        self._insert(int(doc_id), signature)
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+    def signature(self, text: str) -> np.ndarray:
+        words = text.split()
+        n = self.SHINGLE_SIZE
+        shingles = {
+            " ".join(words[i : i + n]) for i in range(max(len(words) - n, 0) + 1)
+        }
+        hashes = np.array(
+            [
+                int.from_bytes(
+                    hashlib.blake2b(shingle.encode(), digest_size=8).digest(), "little"
+                )
+                for shingle in shingles
+            ],
+            dtype=np.uint64,
+        )
+
+        signature = np.full(self.NUM_HASHES, np.iinfo(np.uint32).max, dtype=np.uint64)
+        for start in range(0, len(hashes), self.CHUNK_SIZE):
+            chunk = hashes[start : start + self.CHUNK_SIZE]
+            values = (self._a[:, None] * chunk[None, :] + self._b[:, None]) >> 32
+            np.minimum(signature, values.min(axis=1), out=signature)
+        return signature.astype(np.uint32)
+
+    def find(self, signature: np.ndarray) -> int:
+        """
+        returns:
+            int: doc id of the most similar page above THRESHOLD, None if there is none
+        """
+        candidates = set()
+        for band, key in enumerate(self._band_keys(signature)):
+            candidates.update(self._buckets[band].get(key, ()))
+
+        best, best_similarity = None, self.THRESHOLD
+        for position in candidates:
+            similarity = np.mean(self.signatures[position] == signature)
+            if similarity >= best_similarity:
+                best, best_similarity = self.doc_ids[position], similarity
+        return best
+
+    def add(self, doc_id: int, signature: np.ndarray) -> None:
+        self._insert(doc_id, signature)
+        self._changed = True
+
+    def save(self) -> None:
+        if not self._changed:
+            return
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                version=np.int64(self.VERSION),
+                doc_ids=np.array(self.doc_ids, dtype=np.int64),
+                signatures=np.array(self.signatures, dtype=np.uint32).reshape(
+                    -1, self.NUM_HASHES
+                ),
+            )
+        os.replace(tmp_path, self.path)
+        self._changed = False
+
+    def _insert(self, doc_id: int, signature: np.ndarray) -> None:
+        position = len(self.doc_ids)
+        self.doc_ids.append(doc_id)
+        self.signatures.append(signature)
+        for band, key in enumerate(self._band_keys(signature)):
+            self._buckets[band].setdefault(key, []).append(position)
+
+    def _band_keys(self, signature: np.ndarray) -> list:
+        rows = self.NUM_HASHES // self.BANDS
+        return [
+            signature[band * rows : (band + 1) * rows].tobytes()
+            for band in range(self.BANDS)
+        ]
@@ -1,143 +1,241 @@
-import re
 import os
 import json
-from nltk.corpus import wordnet
-from sklearn.feature_extraction.text import TfidfVectorizer
+import numpy as np
 import tensorflow as tf
+from botlib.cache import LRUCache
+from botlib.classification import ClassificationService
 from botlib.content_generator import ContentGenerator
+from botlib.lazy_loader import LazyLoader, load_report
+from botlib.search_index import SearchIndex
+from botlib.synset_index import SynsetIndex
+from botlib.text_analysis import AnalyzedText, TextAnalyzer
+from botlib.tflite_models import TFLiteModel
+from botlib.training_scheduler import TrainingScheduler
 
 
 class NlpTools:
-    TOKEN_REGEX = r"(?u)\b\w\w+\b"
-    INDEX_PATH = "data/index.json"
+    INDEX_PATH = "data/index"
+    JSON_INDEX_PATH = "data/index.json"
+    SYNSETS_PATH = "data/synsets.json"
+    CLASSIFIER_PATH = "models/CLASS_MODEL"
+    # Quantized export of the classifier (manager_script.py export), used instead
+    # of it while it is up to date
+    CLASSIFIER_TFLITE_PATH = "models/class_model.tflite"
 
     def __init__(self, scrapper_ref) -> None:
-        self.vectorizer = TfidfVectorizer()
-        self.tfidf = None
         self.content_generator = ContentGenerator()
         self.scrapper_ref = scrapper_ref
+        self.analyzer = TextAnalyzer(max_words=ClassificationService.MAX_WORDS)
+        self.query_cache = LRUCache(maxsize=1024, ttl=600)
+        self.training_scheduler = TrainingScheduler(
+            self.content_generator, self.scrapper_ref.contents
+        )
 
-        if os.path.exists(self.INDEX_PATH):
+        if SearchIndex.exists(self.INDEX_PATH) or os.path.exists(self.JSON_INDEX_PATH):
             print("[INFO] Loading index...")
-            self.load_index()
-            self.content_generator.adapt_vectorization(self.scrapper_ref.contents)
+            with load_report.measure("search index"):
+                self.load_index()
+            with load_report.measure("synset index"):
+                self.load_synsets()
         else:
-            self.index = {"[__CURR_ID__]": 0}
+            self.index = SearchIndex()
+            self.synsets = SynsetIndex()
 
-        print("[INFO] Loading classifier...")
-        self.classifier = tf.keras.models.load_model("models/CLASS_MODEL")
+        # Stored pages whose ingestion never finished (the bot stopped with the job
+        # queued, or it failed), see IngestionPipeline.index_unindexed
+        self.unindexed_docs = self.index.missing_docs(len(self.scrapper_ref.store))
+        if self.unindexed_docs:
+            print(f"[INFO] {len(self.unindexed_docs)} stored pages are not indexed")
+
+        self._classifier = LazyLoader("classifier", self._load_classifier)
         print("[INFO] Done initializing NlpTools.")
 
-    def get_inc_curr_id(self) -> int:
-        curr_id = self.index["[__CURR_ID__]"]
-        self.index["[__CURR_ID__]"] += 1
-        return curr_id
+    @property
+    def classifier(self):
+        return self._classifier.get()
+
+    def _load_classifier(self):
+        tflite_model = TFLiteModel.load(
+            self.CLASSIFIER_TFLITE_PATH, self.CLASSIFIER_PATH
+        )
+        if tflite_model is not None:
+            print("[INFO] Using the TFLite classifier")
+            return tflite_model
+        return tf.keras.models.load_model(self.CLASSIFIER_PATH)
+
+    def warm_up(self, gpt: bool = False) -> str:
+        """
+        Loads the models before their first use, meant to run in the background
+        once the bot is ready.
+
+        returns:
+            str: the load report
+        """
+        self.classifier
+        self.content_generator.warm_up(gpt)
+        return load_report.summary()
 
     def load_index(self) -> None:
-        with open(self.INDEX_PATH, "r") as f:
-            self.index = json.load(f)
-
-    def add_document(self, text: str, negative_amount: float) -> None:
-        tokens = self.tokenize(text)
-        doc_id = self.get_inc_curr_id()
-
-        for token in tokens:
-            term_f = self.vectorizer.vocabulary_[token]
-            if token not in self.index:
-                self.index[token] = {}
-            if doc_id not in self.index[token]:
-                self.index[token][doc_id] = [
-                    self.tfidf[doc_id, term_f],
-                    negative_amount,
-                ]
+        if SearchIndex.exists(self.INDEX_PATH):
+            self.index = SearchIndex.load(self.INDEX_PATH)
+            return
 
+        print("[INFO] Migrating data/index.json to the binary index...")
+        with open(self.JSON_INDEX_PATH, "r") as f:
+            data = json.load(f)
+
+        self.index = self._migrate_legacy_index(data)
         self.save_index()
-        return doc_id
+        os.rename(self.JSON_INDEX_PATH, self.JSON_INDEX_PATH + ".bak")
+
+    def load_synsets(self) -> None:
+        if os.path.exists(self.SYNSETS_PATH):
+            self.synsets = SynsetIndex.load(self.SYNSETS_PATH)
+            return
+
+        print("[INFO] Building the WordNet synset index...")
+        self.synsets = SynsetIndex()
+        self.synsets.add_terms(self.index)
+        self.synsets.save(self.SYNSETS_PATH)
+
+    def _migrate_legacy_index(self, data: dict) -> SearchIndex:
+        # The old index stored {term: {doc_id: [tfidf, negative_amount]}}, only the
+        # negative amount can be reused, the term counts come from the stored contents.
+        negativity = {}
+        for term, docs in data.items():
+            if term == "[__CURR_ID__]":
+                continue
+            for doc_id, (_, negative_amount) in docs.items():
+                negativity[int(doc_id)] = negative_amount
+
+        index = SearchIndex()
+        for doc_id in range(data["[__CURR_ID__]"]):
+            tokens = self.tokenize(self.scrapper_ref.contents[doc_id])
+            index.add_document(doc_id, tokens, negativity.get(doc_id, 0.0))
+        return index
+
+    def analyze_stored(self, doc_ids: list) -> list:
+        """
+        returns:
+            list: the analyzed contents of the stored documents
+        """
+        return [self.analyze(self.scrapper_ref.contents[doc_id]) for doc_id in doc_ids]
+
+    def build_index(
+        self, documents: list, doc_ids: list, negative_amounts: list
+    ) -> tuple:
+        """
+        Adds the analyzed documents (see TextAnalyzer) to a copy of the current index
+        (and their new terms to a copy of the synset index) and saves them. The
+        current ones keep serving the searches until publish_index is called.
+
+        Parameters:
+            :doc_ids: Id of each document in the DocumentStore of the scraper.
+
+        returns:
+            tuple: (SearchIndex, SynsetIndex)
+        """
+        index = self.index.copy()
+        terms = set()
+        for document, doc_id, negative_amount in zip(
+            documents, doc_ids, negative_amounts
+        ):
+            terms.update(document.terms)
+            index.add_document(doc_id, document.terms, negative_amount)
+        index.save(self.INDEX_PATH)
+
+        synsets = self.synsets.copy()
+        synsets.add_terms(terms)
+        synsets.save(self.SYNSETS_PATH)
+        return index, synsets
+
+    def publish_index(self, index: SearchIndex, synsets: SynsetIndex) -> None:
+        # Assigning the attributes is atomic, a running search sees either snapshot
+        self.synsets = synsets
+        self.index = index
+
+    def analyze(self, text: str) -> AnalyzedText:
+        return self.analyzer.analyze(text)
 
     def tokenize(self, text: str) -> list:
-        return re.findall(self.TOKEN_REGEX, text.lower())
+        return self.analyzer.tokenize(text)
 
     def save_index(self) -> None:
-        with open(self.INDEX_PATH, "w") as f:
-            json.dump(self.index, f)
-
-    def search(self, query: str) -> dict:
+        self.index.save(self.INDEX_PATH)
+
+    def search(
+        self,
+        query: str,
+        top_k: int = None,
+        mode: str = "or",
+        scorer: str = "tfidf",
+        min_negativity: float = None,
+    ) -> list:
         """
-        Using OR aproach (sum of tfidfs)
+        Ranks the documents with the terms of the query.
+
+        Parameters:
+            :mode: "or" (any of the terms) or "and" (all the terms)
+            :scorer: "tfidf" (sum of tfidfs) or "bm25"
+            :min_negativity: Only documents with negative amount >= min_negativity
 
         returns:
-            dict: {doc_id: [tfidf_sum, negative_amount]}
+            list: [(doc_id, score, negative_amount)] sorted by score, at most top_k
+                (shared with the query cache, must not be modified)
         """
+        index = self.index
         tokens = self.tokenize(query)
-        ret = dict()
-
-        for token in tokens:
-            if token in self.index:
-                for doc in self.index[token]:
-                    if doc in ret:
-                        ret[doc] += self.index[token][doc]
-                    else:
-                        ret[doc] = self.index[token][doc]
-        return ret
-
-    def wn_search(self, search_word: str) -> tuple:
+        # The generation changes with every new document, so a cached result is
+        # never served for an older index than the one being searched.
+        key = (tuple(tokens), top_k, mode, scorer, min_negativity, index.generation)
+        results = self.query_cache.get(key)
+        if results is None:
+            results = index.rank(tokens, top_k, mode, scorer, min_negativity)
+            self.query_cache.put(key, results)
+        return results
+
+    def wn_search(self, search_word: str, top_k: int = None, **kwargs) -> tuple:
         """
         Using WordNet to find the best match for the search_word
 
         returns:
-            tuple: (best_match, [tfidf_sum, negative_amount])
+            tuple: (best_match, [(doc_id, score, negative_amount)])
         """
-        search_word_syn = wordnet.synsets(search_word)
-        if not search_word_syn:
-            return None, None
-
-        search_word_syn = search_word_syn[0]
-        biggest_similarity = 0
-        best_match = None
-        for word in self.index:
-            word_syn = wordnet.synsets(word)
-            if not word_syn:
-                continue
-
-            word_syn = word_syn[0]
-            if word_syn.wup_similarity(search_word_syn) > biggest_similarity:
-                biggest_similarity = word_syn.wup_similarity(search_word_syn)
-                best_match = word
+        best_match = self.synsets.best_match(search_word)
         if not best_match:
             return None, None
 
-        return best_match, self.index[best_match]
-
-    def fit_transform(self) -> None:
-        print("[INFO] Fitting and transforming vectorizer...")
-        self.tfidf = self.vectorizer.fit_transform(self.scrapper_ref.contents)
-        print("[INFO] Fitting and transforming vectrorization...")
-        self.content_generator.adapt_vectorization(self.scrapper_ref.contents)
-        print("[INFO] Training content generator...")
-        self.content_generator.train(self.scrapper_ref.contents)
+        return best_match, self.search(best_match, top_k, **kwargs)
 
     def _convert_scale(self, value: float) -> float:
         return 1 - (value * 2)
 
     def get_negative_amount_texts(self, texts: list) -> list:
-        classification = self.classifier.predict(texts)
+        # A single batch, predict would split it and build a dataset on every call
+        classification = self.classifier.predict_on_batch(np.array(texts, dtype=object))
         # The classifier returns a confidence that goes from 0 to 1, but we need it -1 to 1
         # Using the value[1] because the value[0] is the positive confidence, and we need the negative one
         classification = [self._convert_scale(value[1]) for value in classification]
         return classification
 
-    def generate_text(self, query: str, model: str) -> str:
-        docs = self.search(query)
+    def generation_context(self, query: str) -> str:
+        """
+        returns:
+            str: content of the best document for the query (whitespace collapsed),
+            None if no document matches
+        """
+        docs = self.search(query, top_k=1)
         if not docs:
-            docs = self.wn_search(query)
-            docs = docs[1]
-            print(docs)
-            if docs is None:
+            docs = self.wn_search(query, top_k=1)[1]
+            if not docs:
                 return None
 
-        docs = max(docs, key=lambda x: docs[x][0])
-        content = self.scrapper_ref.contents[int(docs)]
-        processed_string = re.sub(r"\s+", " ", content)
+        return self.analyzer.normalize(self.scrapper_ref.contents[docs[0][0]])
+
+    def generate_text(self, query: str, model: str) -> str:
+        processed_string = self.generation_context(query)
+        if processed_string is None:
+            return None
 
         if model == "inhouse":
             res = self.content_generator.generate_content(processed_string)
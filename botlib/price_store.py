@@ -0,0 +1,122 @@
+import datetime
+import json
+import os
+import numpy as np
+
+DAY_MS = 24 * 60 * 60 * 1000
+
+
+class PriceStore:
+    """
+    Local store of the daily price candles of each asset.
+
+    Besides the candles, each asset keeps the time ranges that were already fetched
+    ("covered"), so only the missing parts of a requested range have to be fetched.
+    The current day is never marked as covered, its candle is still changing.
+
+    One JSON file per asset, with "candles" ({time_ms: priceUsd}), "covered"
+    ([[start_ms, end_ms], ...]) and "version", that only changes when a candle
+    is added or changed.
+    """
+
+    def __init__(self, path: str = "data/prices") -> None:
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self._assets: dict = {}
+        # Sorted (times, prices) arrays of each asset, rebuilt when its version changes
+        self._arrays: dict = {}
+
+    @staticmethod
+    def align(start_ms: int, end_ms: int) -> tuple:
+        """Expands the range to whole (UTC) days"""
+        start_ms = start_ms - start_ms % DAY_MS
+        end_ms = end_ms - end_ms % DAY_MS + DAY_MS - 1
+        return start_ms, end_ms
+
+    def missing_ranges(self, asset_id: str, start_ms: int, end_ms: int) -> list:
+        """
+        returns:
+            list: [[start_ms, end_ms], ...] parts of the range that are not covered
+        """
+        missing = []
+        curr = start_ms
+        for covered_start, covered_end in self._load(asset_id)["covered"]:
+            if covered_end < curr:
+                continue
+            if covered_start > end_ms:
+                break
+            if covered_start > curr:
+                missing.append([curr, covered_start - 1])
+            curr = max(curr, covered_end + 1)
+        if curr <= end_ms:
+            missing.append([curr, end_ms])
+        return missing
+
+    def add(self, asset_id: str, start_ms: int, end_ms: int, candles: list) -> None:
+        """Merges the candles fetched for the range, as returned by the api"""
+        data = self._load(asset_id)
+        changed = False
+        for candle in candles:
+            if data["candles"].get(str(candle["time"])) != candle["priceUsd"]:
+                data["candles"][str(candle["time"])] = candle["priceUsd"]
+                changed = True
+        if changed:
+            data["version"] = data.get("version", 0) + 1
+
+        today_ms = self._today_ms()
+        end_ms = min(end_ms, today_ms - 1)
+        if start_ms <= end_ms:
+            data["covered"] = self._merge(data["covered"] + [[start_ms, end_ms]])
+        self._save(asset_id, data)
+
+    def version(self, asset_id: str) -> int:
+        return self._load(asset_id).get("version", 0)
+
+    def get_arrays(self, asset_id: str, start_ms: int, end_ms: int) -> tuple:
+        """
+        returns:
+            tuple: (times_ms, prices) arrays of the range, sorted by time
+        """
+        version = self.version(asset_id)
+        if asset_id not in self._arrays or self._arrays[asset_id][0] != version:
+            candles = self._load(asset_id)["candles"]
+            times = np.array(list(candles.keys()), dtype=np.int64)
+            prices = np.array(list(candles.values()), dtype=np.float64)
+            order = np.argsort(times)
+            self._arrays[asset_id] = (version, times[order], prices[order])
+
+        _, times, prices = self._arrays[asset_id]
+        start = np.searchsorted(times, start_ms, side="left")
+        end = np.searchsorted(times, end_ms, side="right")
+        return times[start:end], prices[start:end]
+
+    def _merge(self, ranges: list) -> list:
+        merged = []
+        for start, end in sorted(ranges):
+            if merged and start <= merged[-1][1] + 1:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        return merged
+
+    def _today_ms(self) -> int:
+        now = datetime.datetime.now(datetime.timezone.utc).timestamp() * 1e3
+        return int(now) - int(now) % DAY_MS
+
+    def _file(self, asset_id: str) -> str:
+        return os.path.join(self.path, f"{asset_id}.json")
+
+    def _load(self, asset_id: str) -> dict:
+        if asset_id not in self._assets:
+            if os.path.exists(self._file(asset_id)):
+                with open(self._file(asset_id), "r") as f:
+                    self._assets[asset_id] = json.load(f)
+            else:
+                self._assets[asset_id] = {"candles": {}, "covered": []}
+        return self._assets[asset_id]
+
+    def _save(self, asset_id: str, data: dict) -> None:
+        tmp_path = self._file(asset_id) + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self._file(asset_id))
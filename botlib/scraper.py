@@ -1,48 +1,105 @@
-import aiohttp
+import asyncio
 from bs4 import BeautifulSoup
+from collections import deque
+from urllib.parse import urlparse
 import os
 import pickle
 import re
+from .document_store import DocumentStore
+from .http_client import HttpClient
+from .near_duplicates import NearDuplicateIndex
+from .url_set import BloomFilter, UrlHashSet, url_hash
 
 
 class Scraper:
     DOCS_PATH = "data/Docs/"
+    STORE_PATH = "data/store/"
     URLS_PATH = "data/urls.pickle"
     TITLES_PATH = "data/titles.pickle"
     CONTENTS_PATH = "data/contents.pickle"
+    NEAR_DUPLICATES_PATH = "data/near_duplicates.npz"
+    SEEN_URLS_PATH = "data/seen_urls.bin"
+    # Urls of the pages skipped as near-duplicates of stored ones
+    SKIPPED_URLS_PATH = "data/skipped_urls.bin"
 
-    def __init__(self, max_downloads: int = 50) -> None:
+    def __init__(
+        self,
+        http_client: HttpClient,
+        max_downloads: int = 50,
+        max_concurrency: int = 8,
+        per_host_concurrency: int = 2,
+        per_host_delay: float = 0.5,
+        request_timeout: float = 15,
+        frontier_bloom_capacity: int = None,
+    ) -> None:
         self.MAX_DOWNLOADS = max_downloads
+        self.max_concurrency = max_concurrency
+        self.per_host_concurrency = per_host_concurrency
+        self.per_host_delay = per_host_delay
+        # Urls a crawl can discover before the Bloom filter of its frontier degrades,
+        # None keeps them in an exact set
+        self.frontier_bloom_capacity = frontier_bloom_capacity
+        self.http_client = http_client
+        self.http_client.register("scraper", timeout=request_timeout)
+        # Politeness state, shared by all the crawls, see prune_hosts
+        self.host_semaphores: dict = {}
+        self.host_next_request: dict = {}
+        # Requests of each host running or waiting for its semaphore
+        self.host_requests: dict = {}
 
         if not os.path.exists(self.DOCS_PATH):
             os.mkdir(self.DOCS_PATH)
 
-        if not os.path.exists(self.URLS_PATH):
-            self.urls: list = []
-        else:
-            print("[INFO] Loading urls...")
-            self.urls = self.load_pickle(self.URLS_PATH)
+        print("[INFO] Opening document store...")
+        self.store = DocumentStore(self.STORE_PATH)
+        if len(self.store) == 0 and os.path.exists(self.URLS_PATH):
+            self.migrate_pickles()
 
-        if not os.path.exists(self.CONTENTS_PATH):
-            self.contents: list = []
-        else:
-            print("[INFO] Loading contents...")
-            self.contents = self.load_pickle(self.CONTENTS_PATH)
+        self.near_duplicates = NearDuplicateIndex(self.NEAR_DUPLICATES_PATH)
+        if len(self.near_duplicates) < len(self.store):
+            print("[INFO] Fingerprinting the stored pages...")
+            for doc_id in range(len(self.near_duplicates), len(self.store)):
+                signature = self.near_duplicates.signature(self.contents[doc_id])
+                self.near_duplicates.add(doc_id, signature)
+            self.near_duplicates.save()
 
-        if not os.path.exists(self.TITLES_PATH):
-            self.titles: list = []
-        else:
-            print("[INFO] Loading titles...")
-            self.titles = self.load_pickle(self.TITLES_PATH)
+        self.seen_urls = UrlHashSet(self.SEEN_URLS_PATH)
+        if len(self.seen_urls) > len(self.store):
+            self.seen_urls.truncate(len(self.store))
+        elif len(self.seen_urls) < len(self.store):
+            print("[INFO] Hashing the stored urls...")
+            missing = self.urls[len(self.seen_urls) :]
+            self.seen_urls.add_hashes([url_hash(url) for url in missing])
+        self.skipped_urls = UrlHashSet(self.SKIPPED_URLS_PATH)
+
+    @property
+    def urls(self) -> list:
+        return self.store.urls
+
+    @property
+    def titles(self) -> list:
+        return self.store.titles
+
+    @property
+    def contents(self):
+        # Lazy view, each content is only read from disk when accessed
+        return self.store.contents
+
+    def migrate_pickles(self) -> None:
+        print("[INFO] Migrating pickled documents to the document store...")
+        urls = self.load_pickle(self.URLS_PATH)
+        titles = self.load_pickle(self.TITLES_PATH)
+        contents = self.load_pickle(self.CONTENTS_PATH)
+        for url, title, content in zip(urls, titles, contents):
+            self.store.append(url, title, content)
+
+        for path in (self.URLS_PATH, self.TITLES_PATH, self.CONTENTS_PATH):
+            os.rename(path, path + ".bak")
 
     def load_pickle(self, path: str) -> list:
         with open(path, "rb") as f:
             return pickle.load(f)
 
-    def save_pickle(self, path: str, data: list) -> None:
-        with open(path, "wb") as f:
-            pickle.dump(data, f)
-
     def url_to_filename(self, url: str) -> str:
         filename = re.sub(r"(https://)|(http://)", "", url)
         filename = re.sub(r"\W+", "_", filename)
@@ -69,17 +126,23 @@ class Scraper:
         return url
 
     def url_in_db(self, url: str) -> bool:
-        return url in self.urls
+        return self.known_hash(url_hash(url))
+
+    def known_hash(self, h: int) -> bool:
+        """Whether the url of the hash was stored or skipped as a near-duplicate"""
+        return self.seen_urls.contains_hash(h) or self.skipped_urls.contains_hash(h)
+
+    def extract_from_soup(self, soup: BeautifulSoup) -> tuple:
+        """
+        Thread safe, run in an executor as the signature of a long page is slow.
 
-    def extract_from_soup(self, url: str, soup: BeautifulSoup) -> tuple:
+        returns:
+            tuple: (title, content, signature), see NearDuplicateIndex.signature
+        """
         text = soup.get_text()
         title = soup.title.string
         content = self.remove_blank_lines(text.lower())
-
-        self.save_doc(self.url_to_filename(url), content)
-        self.contents.append(content)
-        self.titles.append(str(title))
-        return title, content
+        return title, content, self.near_duplicates.signature(content)
 
     def remove_blank_lines(self, text: str) -> str:
         return "\n".join([line for line in text.split("\n") if line.strip()])
@@ -88,50 +151,124 @@ class Scraper:
         with open(f"{self.DOCS_PATH}{filename}", "w") as f:
             f.write(content)
 
-    async def scrape(self, url: str) -> tuple:
-        url_queue = [url]
+    async def scrape(self, url: str, duplicates: list = None) -> tuple:
+        """
+        Concurrent BFS crawl, up to max_concurrency pages are downloaded at the same
+        time (and per_host_concurrency per host). The (doc_id, title, content) of
+        each page is yielded as soon as its download finishes and it is stored.
+
+        Parameters:
+            :duplicates: Optional list, the (url, url of the stored page) of the
+                near-duplicate pages that were skipped are appended to it.
+        """
+        self.prune_hosts()
+        loop = asyncio.get_running_loop()
+        frontier = deque([url])
         download_count = 0
-        # Using only in this function for its O(1) in func.
-        urls_set = set(self.urls)
+        # Hashes of the urls discovered by this crawl, the stored ones are in seen_urls
+        if self.frontier_bloom_capacity:
+            discovered = BloomFilter(self.frontier_bloom_capacity)
+        else:
+            discovered = set()
+        discovered.add(url_hash(url))
+        pending = set()
 
-        async with aiohttp.ClientSession() as session:
-            while url_queue and download_count < self.MAX_DOWNLOADS:
-                curr_link = url_queue.pop(0)
-                try:
-                    # print(f"[INFO] Downloading {curr_link}")
-                    soup = await self.get_content(curr_link, session)
+        try:
+            while frontier or pending:
+                # Never start more downloads than the remaining budget
+                while (
+                    frontier
+                    and len(pending) < self.max_concurrency
+                    and download_count + len(pending) < self.MAX_DOWNLOADS
+                ):
+                    link = frontier.popleft()
+                    pending.add(asyncio.ensure_future(self.fetch(link)))
+                if not pending:
+                    break
 
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    curr_link, soup = task.result()
                     if not soup:
                         print("Failed to download:", curr_link)
                         continue
+                    try:
+                        for a_tag in soup.find_all("a"):
+                            new_url = self.valid_url(a_tag.get("href"))
+                            if not new_url:
+                                continue
+                            h = url_hash(new_url)
+                            # Already queued by this crawl or seen by a past one
+                            if h in discovered or self.known_hash(h):
+                                continue
+                            discovered.add(h)
+                            frontier.append(new_url)
+
+                        title, content, signature = await loop.run_in_executor(
+                            None, self.extract_from_soup, soup
+                        )
+                    except Exception as e:
+                        print(e)
+                        continue
                     download_count += 1
-                    self.urls.append(curr_link)
+                    duplicate_of = self.near_duplicates.find(signature)
+                    if duplicate_of is not None:
+                        # Not crawled again by the next crawls
+                        self.skipped_urls.add(curr_link)
+                        if duplicates is not None:
+                            duplicates.append((curr_link, self.urls[duplicate_of]))
+                        continue
+                    # Only the new page is saved and appended to the store
+                    self.save_doc(self.url_to_filename(curr_link), content)
+                    doc_id = self.store.append(curr_link, str(title), content)
+                    self.near_duplicates.add(doc_id, signature)
+                    self.seen_urls.add(curr_link)
+                    yield doc_id, title, content
+        finally:
+            for task in pending:
+                task.cancel()
+            self.near_duplicates.save()
+
+    async def fetch(self, url: str) -> tuple:
+        """Downloads a page respecting the per host concurrency and delay"""
+        host = urlparse(url).netloc
+        if host not in self.host_semaphores:
+            self.host_semaphores[host] = asyncio.Semaphore(self.per_host_concurrency)
 
-                    for a_tag in soup.find_all("a"):
-                        url = a_tag.get("href")
-                        url = self.valid_url(url)
-                        if url and (url not in urls_set):
-                            # Set prevents downloading duplicates.
-                            urls_set.add(url)
-                            url_queue.append(url)
+        self.host_requests[host] = self.host_requests.get(host, 0) + 1
+        try:
+            async with self.host_semaphores[host]:
+                # Reserves the next slot of the host before waiting for it
+                now = asyncio.get_running_loop().time()
+                request_time = max(now, self.host_next_request.get(host, now))
+                self.host_next_request[host] = request_time + self.per_host_delay
+                if request_time > now:
+                    await asyncio.sleep(request_time - now)
 
-                    yield self.extract_from_soup(curr_link, soup)
+                try:
+                    return url, await self.get_content(url)
                 except Exception as e:
                     print(e)
-                    if curr_link in self.urls:
-                        self.urls.remove(curr_link)
-                        if len(self.contents) > len(self.urls):
-                            self.contents.pop()
-                        if len(self.titles) > len(self.urls):
-                            self.titles.pop()
-
-        # Data persistence -> Save urls and contents in pickle files
-        self.save_pickle(self.TITLES_PATH, self.titles)
-        self.save_pickle(self.CONTENTS_PATH, self.contents)
-        self.save_pickle(self.URLS_PATH, self.urls)
-
-    async def get_content(self, url: str, session) -> BeautifulSoup:
-        async with session.get(url) as response:
+                    return url, None
+        finally:
+            self.host_requests[host] -= 1
+
+    def prune_hosts(self) -> None:
+        """
+        Forgets the politeness state of the hosts without requests running or
+        waiting and whose delay has passed, it would be the same if they were new.
+        """
+        now = asyncio.get_running_loop().time()
+        for host, n_requests in list(self.host_requests.items()):
+            if n_requests == 0 and self.host_next_request.get(host, now) <= now:
+                del self.host_requests[host]
+                self.host_semaphores.pop(host, None)
+                self.host_next_request.pop(host, None)
+
+    async def get_content(self, url: str) -> BeautifulSoup:
+        async with self.http_client.get("scraper", url) as response:
             content = await response.text()
             if response.status != 200 or not content:
                 return None
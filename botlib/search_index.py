@@ -0,0 +1,563 @@
+import bisect
+import json
+import math
+import os
+import shutil
+from collections import Counter
+import numpy as np
+
+
+def _load_array(path: str) -> np.ndarray:
+    try:
+        return np.load(path, mmap_mode="r")
+    except ValueError:
+        # Empty arrays can't be memory-mapped
+        return np.load(path)
+
+
+class _GrowableColumn:
+    """
+    Numpy array with amortized O(1) append, used for the per-document columns.
+    Setting a position past the end grows it, the gap is filled with fill.
+    """
+
+    def __init__(self, dtype, values=(), fill=0) -> None:
+        values = np.asarray(values, dtype=dtype)
+        self.fill = fill
+        self._data = np.empty(max(len(values) * 2, 64), dtype=dtype)
+        self._data[: len(values)] = values
+        self._size = len(values)
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __getitem__(self, idx):
+        return self.values[idx]
+
+    @property
+    def values(self) -> np.ndarray:
+        return self._data[: self._size]
+
+    def copy(self) -> "_GrowableColumn":
+        return _GrowableColumn(self._data.dtype, self.values, self.fill)
+
+    def append(self, value) -> None:
+        self.set(self._size, value)
+
+    def set(self, idx: int, value) -> None:
+        if idx >= len(self._data):
+            grown = np.empty(max(len(self._data) * 2, idx + 1), dtype=self._data.dtype)
+            grown[: self._size] = self._data[: self._size]
+            self._data = grown
+        if idx >= self._size:
+            self._data[self._size : idx] = self.fill
+            self._size = idx + 1
+        self._data[idx] = value
+
+
+class IndexSegment:
+    """
+    Read-only index written by SearchIndex.save, all the arrays are memory-mapped.
+    Each segment has the postings of the documents added between two saves.
+
+    Layout (one .npy file each):
+        terms:              utf-8 bytes of every term, sorted and concatenated
+        term_offsets:       term i is terms[term_offsets[i]:term_offsets[i + 1]]
+        postings_offsets:   postings of term i are in [postings_offsets[i], postings_offsets[i + 1])
+        doc_ids:            doc id of each posting, sorted by decreasing negativity per term
+        term_counts:        number of times the term occurs in the doc of each posting
+        docs:               ids of the documents of the segment
+        doc_lengths:        number of tokens of each document of docs
+        negativity:         negative amount of each document of docs
+    and a meta.json with the VERSION of the layout.
+    """
+
+    VERSION = 3
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.name = os.path.basename(path)
+        meta_path = os.path.join(path, "meta.json")
+        self.version = 1
+        if os.path.exists(meta_path):
+            with open(meta_path, "r") as f:
+                self.version = json.load(f)["version"]
+        self.terms = _load_array(os.path.join(path, "terms.npy"))
+        self.term_offsets = _load_array(os.path.join(path, "term_offsets.npy"))
+        self.postings_offsets = _load_array(os.path.join(path, "postings_offsets.npy"))
+        self.doc_ids = _load_array(os.path.join(path, "doc_ids.npy"))
+        self.term_counts = _load_array(os.path.join(path, "term_counts.npy"))
+        self.doc_lengths = _load_array(os.path.join(path, "doc_lengths.npy"))
+        self.negativity = _load_array(os.path.join(path, "negativity.npy"))
+        if self.version >= 3:
+            self.docs = _load_array(os.path.join(path, "docs.npy"))
+        else:
+            # A single segment with every document, only read to be rewritten
+            self.docs = np.arange(len(self.doc_lengths), dtype=np.int32)
+
+    def __len__(self) -> int:
+        return len(self.term_offsets) - 1
+
+    def __getitem__(self, i: int) -> bytes:
+        # Allows bisect to binary search the term dictionary without decoding it
+        return self.terms[self.term_offsets[i] : self.term_offsets[i + 1]].tobytes()
+
+    @property
+    def n_docs(self) -> int:
+        return len(self.docs)
+
+    def term_at(self, i: int) -> str:
+        return self[i].decode("utf-8")
+
+    def term_list(self) -> list:
+        """Every term (utf-8 bytes), in order"""
+        terms = self.terms.tobytes()
+        offsets = self.term_offsets.tolist()
+        return [terms[start:end] for start, end in zip(offsets, offsets[1:])]
+
+    def find(self, term: str) -> int:
+        key = term.encode("utf-8")
+        i = bisect.bisect_left(self, key)
+        if i < len(self) and self[i] == key:
+            return i
+        return -1
+
+    def doc_freq(self, i: int) -> int:
+        return int(self.postings_offsets[i + 1] - self.postings_offsets[i])
+
+    def postings(
+        self, i: int, min_negativity: float = None, negativity: np.ndarray = None
+    ) -> tuple:
+        """
+        Parameters:
+            :negativity: Negative amount of every document by doc id (the column of
+                the SearchIndex), required with min_negativity.
+        """
+        start, end = self.postings_offsets[i], self.postings_offsets[i + 1]
+        if min_negativity is not None:
+            # The postings are sorted by decreasing negativity, the allowed documents
+            # are a prefix found by binary search, the rest is never read.
+            negated = _NegatedNegativity(self.doc_ids, negativity, start, end)
+            # Compared in the stored dtype, as the documents not saved yet
+            key = -negativity.dtype.type(min_negativity)
+            end = start + bisect.bisect_right(negated, key)
+        return self.doc_ids[start:end], self.term_counts[start:end]
+
+
+class _NegatedNegativity:
+    """Increasing view of the negativity of the docs of a postings range, for bisect"""
+
+    def __init__(
+        self, doc_ids: np.ndarray, negativity: np.ndarray, start: int, end: int
+    ) -> None:
+        self.doc_ids = doc_ids
+        self.negativity = negativity
+        self.start = start
+        self.end = end
+
+    def __len__(self) -> int:
+        return int(self.end - self.start)
+
+    def __getitem__(self, i: int):
+        return -self.negativity[self.doc_ids[self.start + i]]
+
+
+def _write_segment(path: str, parts: list, docs, doc_lengths, negativity) -> None:
+    """
+    Writes the postings of the parts as a single segment.
+
+    Parameters:
+        :parts: [(terms, doc_freqs, doc_ids, term_counts)], the
+            utf-8 terms of each part and the number of postings of each of them,
+            followed by their postings (grouped by term, in the same order).
+        :docs: Ids of the documents of the postings, with their doc_lengths and
+            negativity.
+    """
+    terms = [term for part in parts for term in part[0]]
+    unique_terms, inverse = np.unique(
+        np.array(terms, dtype=object), return_inverse=True
+    )
+    # Position of the term of each posting in unique_terms
+    posting_terms = np.repeat(
+        inverse, np.concatenate([part[1] for part in parts]).astype(np.int64)
+    )
+    doc_ids = np.concatenate([part[2] for part in parts]).astype(np.int32)
+    term_counts = np.concatenate([part[3] for part in parts]).astype(np.int32)
+    docs = np.asarray(docs, dtype=np.int32)
+    docs_order = np.argsort(docs, kind="stable")
+    docs = docs[docs_order]
+    negativity = np.asarray(negativity, dtype=np.float32)[docs_order]
+    # Every posting is of one of the docs, its negativity is looked up there
+    posting_negativity = negativity[np.searchsorted(docs, doc_ids)]
+    # Grouped by term, sorted by decreasing negativity, see IndexSegment.postings
+    order = np.lexsort((doc_ids, -posting_negativity, posting_terms))
+
+    term_offsets = np.zeros(len(unique_terms) + 1, dtype=np.int64)
+    term_offsets[1:] = np.cumsum([len(term) for term in unique_terms])
+    postings_offsets = np.zeros(len(unique_terms) + 1, dtype=np.int64)
+    postings_offsets[1:] = np.cumsum(
+        np.bincount(posting_terms, minlength=len(unique_terms))
+    )
+    arrays = {
+        "terms": np.frombuffer(b"".join(unique_terms), dtype=np.uint8),
+        "term_offsets": term_offsets,
+        "postings_offsets": postings_offsets,
+        "doc_ids": doc_ids[order],
+        "term_counts": term_counts[order],
+        "docs": docs,
+        "doc_lengths": np.asarray(doc_lengths, dtype=np.int32)[docs_order],
+        "negativity": negativity,
+    }
+    os.makedirs(path, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(path, f"{name}.npy"), array)
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump({"version": IndexSegment.VERSION}, f)
+
+
+class SearchIndex:
+    """
+    Incremental inverted index.
+
+    Only raw term counts and per-document statistics are stored, the IDF of each
+    term is computed when a query runs, so adding a document never touches the
+    postings of the documents already indexed.
+
+    Documents are identified by their doc id in the DocumentStore, they can be
+    added in any order (concurrent crawls interleave their pages in the store).
+    The length of the documents that are not indexed (yet) is -1.
+
+    The persisted documents live in memory-mapped IndexSegments, the documents
+    added since the last save are kept in memory until the next save writes them
+    as a new segment. Saving only writes the new documents, the small segments
+    are merged in tiers: once MERGE_FACTOR segments of about the same size are
+    the last ones, they are merged into one, so a search reads O(log(n_docs))
+    segments and each posting is rewritten O(log(n_docs)) times.
+    """
+
+    CURRENT_FILE = "CURRENT"
+    MODES = ("or", "and")
+    SCORERS = ("tfidf", "bm25")
+    BM25_K1 = 1.2
+    BM25_B = 0.75
+    MERGE_FACTOR = 4
+
+    def __init__(self, segments: list = ()) -> None:
+        self.segments = list(segments)
+        # Postings added since the last save: {term: [(doc_id, term_count), ...]}
+        self.new_postings: dict = {}
+        # Ids of the documents added since the last save
+        self.new_docs: list = []
+        size = max(
+            (int(segment.docs.max(initial=-1)) for segment in self.segments),
+            default=-1,
+        )
+        doc_lengths = np.full(size + 1, -1, dtype=np.int32)
+        negativity = np.zeros(size + 1, dtype=np.float32)
+        for segment in self.segments:
+            doc_lengths[segment.docs] = segment.doc_lengths
+            negativity[segment.docs] = segment.negativity
+        self.doc_lengths = _GrowableColumn(np.int32, doc_lengths, fill=-1)
+        self.negativity = _GrowableColumn(np.float32, negativity)
+        # Number of indexed documents, and their total length for the BM25 average
+        self.n_docs = sum(segment.n_docs for segment in self.segments)
+        self.total_length = int(doc_lengths[doc_lengths > 0].sum())
+        # Bumped by every add_document, results cached for a generation stay valid
+        self.generation = 0
+
+    def __contains__(self, term: str) -> bool:
+        if term in self.new_postings:
+            return True
+        return any(segment.find(term) >= 0 for segment in self.segments)
+
+    def __iter__(self):
+        seen = set()
+        for segment in self.segments:
+            for i in range(len(segment)):
+                term = segment.term_at(i)
+                if term not in seen:
+                    seen.add(term)
+                    yield term
+        for term in self.new_postings:
+            if term not in seen:
+                yield term
+
+    def copy(self) -> "SearchIndex":
+        """Copy that shares the (read-only) segments, used to build the next snapshot"""
+        index = SearchIndex()
+        index.segments = list(self.segments)
+        index.new_postings = {
+            term: list(postings) for term, postings in self.new_postings.items()
+        }
+        index.new_docs = list(self.new_docs)
+        index.doc_lengths = self.doc_lengths.copy()
+        index.negativity = self.negativity.copy()
+        index.n_docs = self.n_docs
+        index.total_length = self.total_length
+        index.generation = self.generation
+        return index
+
+    def is_indexed(self, doc_id: int) -> bool:
+        return doc_id < len(self.doc_lengths) and self.doc_lengths[doc_id] >= 0
+
+    def missing_docs(self, n_docs: int) -> list:
+        """
+        returns:
+            list: ids of the first n_docs documents that are not indexed
+        """
+        missing = np.flatnonzero(self.doc_lengths.values[:n_docs] < 0).tolist()
+        return missing + list(range(len(self.doc_lengths), n_docs))
+
+    def add_document(self, doc_id: int, tokens: list, negative_amount: float) -> None:
+        if self.is_indexed(doc_id):
+            raise ValueError(f"Document {doc_id} is already indexed")
+        for term, count in Counter(tokens).items():
+            self.new_postings.setdefault(term, []).append((doc_id, count))
+
+        self.new_docs.append(doc_id)
+        self.doc_lengths.set(doc_id, len(tokens))
+        self.negativity.set(doc_id, negative_amount)
+        self.n_docs += 1
+        self.total_length += len(tokens)
+        self.generation += 1
+
+    def postings(self, term: str, min_negativity: float = None) -> tuple:
+        """
+        returns:
+            tuple: (doc_ids, term_counts) arrays, only of the documents with
+                negative amount >= min_negativity if it is given
+        """
+        doc_ids = [np.empty(0, dtype=np.int32)]
+        counts = [np.empty(0, dtype=np.int32)]
+        if min_negativity is not None:
+            # The same document must pass the filter before and after it is saved
+            min_negativity = self.negativity.values.dtype.type(min_negativity)
+        for segment in self.segments:
+            i = segment.find(term)
+            if i >= 0:
+                seg_doc_ids, seg_counts = segment.postings(
+                    i, min_negativity, self.negativity.values
+                )
+                doc_ids.append(seg_doc_ids)
+                counts.append(seg_counts)
+        if term in self.new_postings:
+            new_doc_ids, new_counts = zip(*self.new_postings[term])
+            new_doc_ids = np.array(new_doc_ids, dtype=np.int32)
+            new_counts = np.array(new_counts, dtype=np.int32)
+            if min_negativity is not None:
+                allowed = self.negativity.values[new_doc_ids] >= min_negativity
+                new_doc_ids, new_counts = new_doc_ids[allowed], new_counts[allowed]
+            doc_ids.append(new_doc_ids)
+            counts.append(new_counts)
+        return np.concatenate(doc_ids), np.concatenate(counts)
+
+    def doc_freq(self, term: str) -> int:
+        doc_freq = len(self.new_postings.get(term, ()))
+        for segment in self.segments:
+            i = segment.find(term)
+            if i >= 0:
+                doc_freq += segment.doc_freq(i)
+        return doc_freq
+
+    def idf(self, term: str, doc_freq: int = None) -> float:
+        if doc_freq is None:
+            doc_freq = self.doc_freq(term)
+        # Same smoothed idf used by sklearn's TfidfVectorizer
+        return math.log((1 + self.n_docs) / (1 + doc_freq)) + 1
+
+    def weights(
+        self, term: str, scorer: str = "tfidf", min_negativity: float = None
+    ) -> tuple:
+        """
+        returns:
+            tuple: (doc_ids, weights) arrays of the documents that contain the term
+                (and have negative amount >= min_negativity if it is given)
+        """
+        doc_ids, counts = self.postings(term, min_negativity)
+        if len(doc_ids) == 0:
+            return doc_ids, np.empty(0, dtype=np.float64)
+
+        # The IDF always uses every document, not only the allowed ones
+        doc_freq = self.doc_freq(term)
+        doc_lengths = self.doc_lengths.values[doc_ids]
+        if scorer == "tfidf":
+            return doc_ids, counts / doc_lengths * self.idf(term, doc_freq)
+
+        # BM25
+        idf = math.log(1 + (self.n_docs - doc_freq + 0.5) / (doc_freq + 0.5))
+        avg_length = self.total_length / self.n_docs
+        norm = self.BM25_K1 * (1 - self.BM25_B + self.BM25_B * doc_lengths / avg_length)
+        return doc_ids, idf * counts * (self.BM25_K1 + 1) / (counts + norm)
+
+    def rank(
+        self,
+        terms: list,
+        top_k: int = None,
+        mode: str = "or",
+        scorer: str = "tfidf",
+        min_negativity: float = None,
+    ) -> list:
+        """
+        Scores the documents that contain any (mode="or") or all (mode="and") of the
+        terms, with the sum of the term weights. The min_negativity filter is applied
+        while reading the postings, so the filtered documents are never scored.
+
+        returns:
+            list: [(doc_id, score, negative_amount)] sorted by score, at most top_k
+        """
+        if mode not in self.MODES:
+            raise ValueError(f"Invalid mode {mode}, expected one of {self.MODES}")
+        if scorer not in self.SCORERS:
+            raise ValueError(f"Invalid scorer {scorer}, expected one of {self.SCORERS}")
+
+        terms = list(dict.fromkeys(terms))
+        all_doc_ids = []
+        all_weights = []
+        for term in terms:
+            doc_ids, weights = self.weights(term, scorer, min_negativity)
+            if len(doc_ids) == 0 and mode == "and":
+                return []
+            all_doc_ids.append(doc_ids)
+            all_weights.append(weights)
+        if not all_doc_ids:
+            return []
+
+        # Sparse sum: only the documents in the postings are touched
+        doc_ids, inverse = np.unique(np.concatenate(all_doc_ids), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(all_weights))
+        if mode == "and":
+            matched = np.bincount(inverse) == len(terms)
+            doc_ids, scores = doc_ids[matched], scores[matched]
+
+        negativity = self.negativity.values[doc_ids]
+        if top_k is not None and len(doc_ids) > top_k:
+            best = np.argpartition(-scores, top_k - 1)[:top_k]
+            doc_ids, scores, negativity = doc_ids[best], scores[best], negativity[best]
+        order = np.argsort(-scores, kind="stable")
+        return list(
+            zip(
+                doc_ids[order].tolist(),
+                scores[order].tolist(),
+                negativity[order].tolist(),
+            )
+        )
+
+    def save(self, path: str) -> None:
+        """
+        Writes the documents added since the last save as a new segment (merging
+        the last segments if needed), the CURRENT file is only replaced once the
+        segments are complete.
+        """
+        if not self.new_docs:
+            return
+        os.makedirs(path, exist_ok=True)
+        previous = self._current_segments(path)
+
+        terms = [term.encode("utf-8") for term in self.new_postings]
+        postings = [posting for term in self.new_postings.values() for posting in term]
+        doc_ids, counts = np.array(postings, dtype=np.int32).reshape(-1, 2).T
+        part = (
+            terms,
+            [len(term) for term in self.new_postings.values()],
+            doc_ids,
+            counts,
+        )
+        segment_path = os.path.join(path, self._next_segment_name(path))
+        docs = np.array(self.new_docs, dtype=np.int32)
+        _write_segment(
+            segment_path,
+            [part],
+            docs,
+            self.doc_lengths.values[docs],
+            self.negativity.values[docs],
+        )
+        segments = self.segments + [IndexSegment(segment_path)]
+
+        # Tiered merge, the segments are ordered from the oldest (largest) one
+        while True:
+            tier = self._tier(segments[-1])
+            n_merged = 1
+            while (
+                n_merged < len(segments) and self._tier(segments[-n_merged - 1]) <= tier
+            ):
+                n_merged += 1
+            if n_merged < self.MERGE_FACTOR:
+                break
+            merged = self._merge(path, segments[-n_merged:])
+            segments = segments[:-n_merged] + [merged]
+
+        self._write_current(path, segments)
+        self.segments = segments
+        self.new_postings = {}
+        self.new_docs = []
+        # Keeps the previous segments, they may still be mapped by a reader
+        keep = {segment.name for segment in segments} | set(previous)
+        for name in os.listdir(path):
+            if name.startswith("gen-") and name not in keep:
+                shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+
+    @classmethod
+    def load(cls, path: str) -> "SearchIndex":
+        segments = [
+            IndexSegment(os.path.join(path, name))
+            for name in cls._current_segments(path)
+        ]
+        if any(segment.version < IndexSegment.VERSION for segment in segments):
+            print("[INFO] Rewriting the index segments in the current layout...")
+            segments = [cls._merge(path, segments)]
+            cls._write_current(path, segments)
+        return cls(segments)
+
+    @classmethod
+    def exists(cls, path: str) -> bool:
+        return os.path.exists(os.path.join(path, cls.CURRENT_FILE))
+
+    @classmethod
+    def _merge(cls, path: str, segments: list) -> IndexSegment:
+        parts = [
+            (
+                segment.term_list(),
+                np.diff(segment.postings_offsets),
+                segment.doc_ids,
+                segment.term_counts,
+            )
+            for segment in segments
+        ]
+        segment_path = os.path.join(path, cls._next_segment_name(path))
+        _write_segment(
+            segment_path,
+            parts,
+            np.concatenate([segment.docs for segment in segments]),
+            np.concatenate([segment.doc_lengths for segment in segments]),
+            np.concatenate([segment.negativity for segment in segments]),
+        )
+        return IndexSegment(segment_path)
+
+    @classmethod
+    def _tier(cls, segment: IndexSegment) -> int:
+        return int(math.log(max(segment.n_docs, 1), cls.MERGE_FACTOR))
+
+    @classmethod
+    def _current_segments(cls, path: str) -> list:
+        if not cls.exists(path):
+            return []
+        with open(os.path.join(path, cls.CURRENT_FILE), "r") as f:
+            # One segment name per line, from the oldest to the newest
+            return f.read().split()
+
+    @classmethod
+    def _write_current(cls, path: str, segments: list) -> None:
+        # Atomic switch to the new segments
+        tmp_current = os.path.join(path, cls.CURRENT_FILE + ".tmp")
+        with open(tmp_current, "w") as f:
+            f.write("\n".join(segment.name for segment in segments))
+        os.replace(tmp_current, os.path.join(path, cls.CURRENT_FILE))
+
+    @staticmethod
+    def _next_segment_name(path: str) -> str:
+        generations = [
+            int(name.split("-")[1])
+            for name in os.listdir(path)
+            if name.startswith("gen-")
+        ]
+        return f"gen-{max(generations, default=0) + 1:06d}"
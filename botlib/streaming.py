@@ -0,0 +1,32 @@
+import asyncio
+
+_DONE = object()
+
+
+async def stream_in_executor(executor, generate, *args):
+    """
+    Runs a (blocking) generator function in the executor and yields its items in
+    the event loop as soon as they are produced.
+
+    Parameters:
+        :executor: Executor the generator runs on, None for the default one.
+        :generate: Generator function, called with args.
+    """
+    loop = asyncio.get_running_loop()
+    items = asyncio.Queue()
+
+    def produce():
+        try:
+            for item in generate(*args):
+                loop.call_soon_threadsafe(items.put_nowait, item)
+        finally:
+            loop.call_soon_threadsafe(items.put_nowait, _DONE)
+
+    producer = loop.run_in_executor(executor, produce)
+    while True:
+        item = await items.get()
+        if item is _DONE:
+            break
+        yield item
+    # Raises the exception of the generator, if any
+    await producer
@@ -0,0 +1,181 @@
+import bisect
+import json
+import os
+from nltk.corpus import wordnet
+
+
+class SynsetIndex:
+    """
+    Precomputed term -> synset table used by the WordNet search.
+
+    Each term is mapped to its first synset once, when it is added to the index.
+    Terms with the same synset are scored once, and only synsets with the same
+    POS as the query can have a similarity (wup_similarity returns None otherwise).
+
+    Nouns are also grouped by their hypernyms at depth BRANCH_DEPTH. If two nouns
+    don't share one of those hypernyms, their lowest common hypernym has a max depth
+    smaller than BRANCH_DEPTH, so:
+        wup_similarity <= 2 * BRANCH_DEPTH / (min_depth_1 + min_depth_2 + 2)
+    The nouns of other branches are visited by increasing depth and the search stops
+    once that bound can't beat the best similarity found.
+    """
+
+    BRANCH_DEPTH = 4
+    MEMO_SIZE = 1024
+
+    def __init__(self) -> None:
+        # {term: synset_name or None}
+        self.terms: dict = {}
+        # {synset_name: {"pos", "min_depth", "branches", "terms"}}
+        self.synsets: dict = {}
+        # {branch_synset_name: set of noun synset names}
+        self.branches: dict = {}
+        # (min_depth, synset_name) of every noun, sorted
+        self.nouns_by_depth: list = []
+        self._synset_objects: dict = {}
+        self._memo: dict = {}
+
+    def __len__(self) -> int:
+        return len(self.terms)
+
+    def add_terms(self, terms) -> None:
+        for term in terms:
+            if term in self.terms:
+                continue
+            synsets = wordnet.synsets(term)
+            if not synsets:
+                self.terms[term] = None
+                continue
+
+            synset = synsets[0]
+            name = synset.name()
+            self.terms[term] = name
+            if name in self.synsets:
+                self.synsets[name]["terms"].append(term)
+                continue
+
+            branches = set()
+            if synset.pos() == "n":
+                for path in synset.hypernym_paths():
+                    if len(path) > self.BRANCH_DEPTH:
+                        branches.add(path[self.BRANCH_DEPTH].name())
+            self._add_synset(
+                name, synset.pos(), synset.min_depth(), sorted(branches), [term]
+            )
+        self._memo.clear()
+
+    def _add_synset(
+        self, name, pos, min_depth, branches, terms, keep_sorted=True
+    ) -> None:
+        self.synsets[name] = {
+            "pos": pos,
+            "min_depth": min_depth,
+            "branches": branches,
+            "terms": terms,
+        }
+        if pos == "n":
+            for branch in branches:
+                self.branches.setdefault(branch, set()).add(name)
+            if keep_sorted:
+                bisect.insort(self.nouns_by_depth, (min_depth, name))
+            else:
+                self.nouns_by_depth.append((min_depth, name))
+
+    def best_match(self, search_word: str) -> str:
+        """
+        returns:
+            str: the indexed term with the biggest wup_similarity to the search_word,
+                or None if there is no match
+        """
+        if search_word in self._memo:
+            return self._memo[search_word]
+
+        query_synsets = wordnet.synsets(search_word)
+        best_match = None
+        if query_synsets:
+            best_match = self._best_match(query_synsets[0])
+
+        if len(self._memo) >= self.MEMO_SIZE:
+            self._memo.clear()
+        self._memo[search_word] = best_match
+        return best_match
+
+    def _best_match(self, query) -> str:
+        biggest_similarity = 0
+        best_synset = None
+
+        def score(name):
+            nonlocal biggest_similarity, best_synset
+            similarity = self._synset(name).wup_similarity(query)
+            if similarity is not None and similarity > biggest_similarity:
+                biggest_similarity = similarity
+                best_synset = name
+
+        if query.pos() != "n":
+            for name, synset in self.synsets.items():
+                if synset["pos"] == query.pos():
+                    score(name)
+        else:
+            same_branch = set()
+            for path in query.hypernym_paths():
+                if len(path) > self.BRANCH_DEPTH:
+                    same_branch.update(
+                        self.branches.get(path[self.BRANCH_DEPTH].name(), ())
+                    )
+            for name in same_branch:
+                score(name)
+
+            query_depth = query.min_depth()
+            for min_depth, name in self.nouns_by_depth:
+                bound = 2 * self.BRANCH_DEPTH / (query_depth + min_depth + 2)
+                if bound <= biggest_similarity:
+                    break
+                if name not in same_branch:
+                    score(name)
+
+        if best_synset is None:
+            return None
+        return self.synsets[best_synset]["terms"][0]
+
+    def _synset(self, name: str):
+        if name not in self._synset_objects:
+            self._synset_objects[name] = wordnet.synset(name)
+        return self._synset_objects[name]
+
+    def copy(self) -> "SynsetIndex":
+        """Copy to be updated while this one keeps serving the searches"""
+        index = SynsetIndex()
+        index.terms = dict(self.terms)
+        index.synsets = {
+            name: dict(synset, terms=list(synset["terms"]))
+            for name, synset in self.synsets.items()
+        }
+        index.branches = {branch: set(names) for branch, names in self.branches.items()}
+        index.nouns_by_depth = list(self.nouns_by_depth)
+        index._synset_objects = dict(self._synset_objects)
+        return index
+
+    def save(self, path: str) -> None:
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"terms": self.terms, "synsets": self.synsets}, f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "SynsetIndex":
+        with open(path, "r") as f:
+            data = json.load(f)
+
+        index = cls()
+        index.terms = data["terms"]
+        for name, synset in data["synsets"].items():
+            index._add_synset(
+                name,
+                synset["pos"],
+                synset["min_depth"],
+                synset["branches"],
+                synset["terms"],
+                keep_sorted=False,
+            )
+        index.nouns_by_depth.sort()
+        return index
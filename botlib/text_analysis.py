@@ -0,0 +1,50 @@
+import re
+
+
+class AnalyzedText:
+    """
+    A document analyzed once, shared by every stage of the ingestion.
+
+    Attributes:
+        :words: The first words of the text (split on whitespace), see
+            TextAnalyzer.max_words.
+        :terms: The index terms (lowercase tokens of two or more characters).
+    """
+
+    __slots__ = ("words", "terms")
+
+    def __init__(self, words: list, terms: list) -> None:
+        self.words = words
+        self.terms = terms
+
+
+class TextAnalyzer:
+    """
+    Tokenizes the documents once for every stage of the ingestion, the search
+    index uses the terms and the classifier the (truncated) words.
+    """
+
+    TOKEN_REGEX = re.compile(r"(?u)\b\w\w+\b")
+
+    def __init__(self, max_words: int = None) -> None:
+        """
+        Parameters:
+            :max_words: Words kept of each document (the classifier only reads the
+                first ones), None keeps all of them.
+        """
+        self.max_words = max_words
+
+    def analyze(self, text: str) -> AnalyzedText:
+        # The terms never contain whitespace, the text is not normalized first
+        if self.max_words is None:
+            words = text.split()
+        else:
+            # The rest of the text is left in one last piece, dropped
+            words = text.split(None, self.max_words)[: self.max_words]
+        return AnalyzedText(words, self.tokenize(text))
+
+    def normalize(self, text: str) -> str:
+        return " ".join(text.split())
+
+    def tokenize(self, text: str) -> list:
+        return self.TOKEN_REGEX.findall(text.lower())
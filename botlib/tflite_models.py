@@ -0,0 +1,160 @@
+import json
+import os
+import threading
+import time
+import numpy as np
+import tensorflow as tf
+
+# Weights stored as int8 (dynamic range) or float16, activations stay in float.
+# Full int8 quantization does not apply, both models start with a lookup
+# (strings or token ids) that can't be quantized.
+QUANTIZATIONS = ("dynamic", "float16")
+
+
+class TFLiteModel:
+    """
+    Keras model exported to TFLite, run with the TFLite interpreter.
+
+    Has the predict_on_batch of a Keras model, so it can replace one for inference.
+    The interpreter is not thread safe, the calls are serialized with a lock.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.interpreter = tf.lite.Interpreter(model_path=path)
+        self.interpreter.allocate_tensors()
+        self.input_details = self.interpreter.get_input_details()[0]
+        self.output_details = self.interpreter.get_output_details()[0]
+        self._lock = threading.Lock()
+
+    @property
+    def input_dtype(self):
+        return self.input_details["dtype"]
+
+    def predict_on_batch(self, x) -> np.ndarray:
+        x = np.asarray(x)
+        if self.input_dtype == np.bytes_ or self.input_dtype == np.object_:
+            x = np.array([str(value).encode("utf-8") for value in x.ravel()])
+        else:
+            x = x.astype(self.input_dtype)
+        x = x.reshape(-1, *self.input_details["shape"][1:])
+
+        with self._lock:
+            if tuple(self.input_details["shape"]) != x.shape:
+                # The batch size changed, the tensors must be allocated again
+                self.interpreter.resize_tensor_input(
+                    self.input_details["index"], x.shape
+                )
+                self.interpreter.allocate_tensors()
+                self.input_details = self.interpreter.get_input_details()[0]
+                self.output_details = self.interpreter.get_output_details()[0]
+            self.interpreter.set_tensor(self.input_details["index"], x)
+            self.interpreter.invoke()
+            return self.interpreter.get_tensor(self.output_details["index"])
+
+    @staticmethod
+    def is_up_to_date(path: str, source_path: str) -> bool:
+        """
+        returns:
+            bool: if the TFLite file exists and was exported from the current
+            version of the source model (it changes when the model is trained)
+        """
+        if not (os.path.exists(path) and os.path.exists(path + ".json")):
+            return False
+        with open(path + ".json", "r") as f:
+            meta = json.load(f)
+        return meta.get("source_mtime") == _source_mtime(source_path)
+
+    @classmethod
+    def load(cls, path: str, source_path: str):
+        """
+        returns:
+            TFLiteModel: None if the TFLite file is missing or outdated
+        """
+        if not cls.is_up_to_date(path, source_path):
+            return None
+        return cls(path)
+
+
+def export_tflite(
+    model: tf.keras.Model, path: str, source_path: str, quantization: str = "dynamic"
+) -> dict:
+    """
+    Converts the Keras model (loaded from source_path) to TFLite and saves it,
+    with a metadata file used to know when it is outdated.
+
+    returns:
+        dict: the metadata (quantization, size in bytes, source model version)
+    """
+    if quantization not in QUANTIZATIONS:
+        raise ValueError(f"Invalid quantization {quantization}")
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantization == "float16":
+        converter.target_spec.supported_types = [tf.float16]
+    # Text vectorization and the LSTMs need some TensorFlow ops
+    converter.target_spec.supported_ops = [
+        tf.lite.OpsSet.TFLITE_BUILTINS,
+        tf.lite.OpsSet.SELECT_TF_OPS,
+    ]
+    converter._experimental_lower_tensor_list_ops = False
+    tflite_model = converter.convert()
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(tflite_model)
+    os.replace(tmp_path, path)
+
+    meta = {
+        "quantization": quantization,
+        "size": len(tflite_model),
+        "source_mtime": _source_mtime(source_path),
+    }
+    with open(path + ".json", "w") as f:
+        json.dump(meta, f)
+    return meta
+
+
+def compare_models(
+    keras_model: tf.keras.Model, tflite_model: TFLiteModel, batches: list
+) -> dict:
+    """
+    Runs both models on the same batches.
+
+    returns:
+        dict: mean latency per call of each model (seconds), the largest absolute
+        difference between the outputs and how often the best class is the same
+    """
+    keras_time = tflite_time = 0.0
+    max_abs_diff = 0.0
+    same_argmax = total = 0
+    for batch in batches:
+        start = time.perf_counter()
+        expected = np.asarray(keras_model.predict_on_batch(batch))
+        keras_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        output = tflite_model.predict_on_batch(batch)
+        tflite_time += time.perf_counter() - start
+
+        max_abs_diff = max(max_abs_diff, float(np.abs(expected - output).max()))
+        same_argmax += int((expected.argmax(-1) == output.argmax(-1)).sum())
+        total += len(expected)
+
+    return {
+        "keras_latency": keras_time / len(batches),
+        "tflite_latency": tflite_time / len(batches),
+        "max_abs_diff": max_abs_diff,
+        "argmax_agreement": same_argmax / total if total else 1.0,
+    }
+
+
+def _source_mtime(source_path: str) -> float:
+    # Last modification of any file of the SavedModel directory
+    mtimes = [
+        os.path.getmtime(os.path.join(root, file))
+        for root, _, files in os.walk(source_path)
+        for file in files
+    ]
+    return max(mtimes, default=0.0)
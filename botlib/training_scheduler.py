@@ -0,0 +1,179 @@
+import hashlib
+import json
+import os
+import random
+import time
+import numpy as np
+
+
+class TrainingScheduler:
+    """
+    Decides when the content generator is trained and on which documents.
+
+    The documents of the store are sequential, so the state only needs the number of
+    documents the model was already trained on. The first run waits for at least
+    min_new_docs documents, adapts the vocabulary on them and trains the model (the
+    checkpoint in MODEL_PATH if there is one) for n_training_epochs. The next ones
+    fine-tune it on the new documents only (plus a small replay sample of the old
+    ones), once at least min_new_docs are waiting or max_interval seconds have passed.
+
+    Re-adapting the vocabulary would change the token ids the checkpoint was trained
+    with, instead the frequent new words of each run are appended to its unused
+    slots (see ContentGenerator.extend_vocabulary), the ids of the known words never
+    change. The token ids of the documents are kept (TOKEN_IDS_PATH) and reused by
+    the next runs while the vocabulary stays the same.
+    """
+
+    STATE_PATH = "models/training_state.json"
+    TOKEN_IDS_PATH = "models/token_ids.npz"
+
+    def __init__(
+        self,
+        content_generator,
+        contents,
+        min_new_docs: int = 50,
+        max_interval: float = 6 * 3600,
+        fine_tune_epochs: int = 3,
+        replay_ratio: float = 0.2,
+    ) -> None:
+        self.content_generator = content_generator
+        self.contents = contents
+        self.min_new_docs = min_new_docs
+        self.max_interval = max_interval
+        self.fine_tune_epochs = fine_tune_epochs
+        self.replay_ratio = replay_ratio
+        self.state = {"trained_docs": 0, "vocabulary_docs": 0, "last_run": 0.0}
+
+        if os.path.exists(self.STATE_PATH):
+            with open(self.STATE_PATH, "r") as f:
+                self.state.update(json.load(f))
+        elif os.path.exists(content_generator.MODEL_PATH):
+            # Checkpoint from before the scheduler, it was trained on every document
+            self.state["trained_docs"] = len(self.contents)
+            self.state["vocabulary_docs"] = len(self.contents)
+        if self.state["vocabulary_docs"] > len(self.contents):
+            # The documents were cleaned up, start over
+            self.state = {"trained_docs": 0, "vocabulary_docs": 0, "last_run": 0.0}
+        # The vocabulary is re-created when the content generator first needs it
+        content_generator.vocabulary_texts = self.vocabulary_texts
+
+    @property
+    def pending_docs(self) -> int:
+        return len(self.contents) - self.state["trained_docs"]
+
+    def vocabulary_texts(self):
+        """
+        returns:
+            _LazyTexts: the texts the vocabulary of the checkpoint was adapted on,
+            None before the first run
+        """
+        n_docs = self.state["vocabulary_docs"]
+        return self._texts(range(n_docs)) if n_docs else None
+
+    def should_train(self) -> bool:
+        if self.pending_docs <= 0:
+            return False
+        if self.state["vocabulary_docs"] == 0:
+            # The vocabulary is adapted on the first run, a single crawl is too few
+            return self.pending_docs >= self.min_new_docs
+        if self.pending_docs >= self.min_new_docs:
+            return True
+        return time.time() - self.state["last_run"] >= self.max_interval
+
+    def train(self) -> dict:
+        """
+        returns:
+            dict: report of the run (documents used, epochs, wall and cpu time)
+        """
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+
+        trained_docs = self.state["trained_docs"]
+        new_docs = range(trained_docs, len(self.contents))
+        if self.state["vocabulary_docs"] == 0:
+            self.content_generator.adapt_vectorization(self._texts(new_docs))
+            # Pages stored while adapting are not part of the vocabulary
+            self.state["vocabulary_docs"] = new_docs.stop
+            replay_docs = []
+            epochs = self.content_generator.n_training_epochs
+        else:
+            self.content_generator.extend_vocabulary(
+                self._texts(new_docs), new_docs.stop
+            )
+            self.state["vocabulary_docs"] = new_docs.stop
+            n_replay = min(trained_docs, int(len(new_docs) * self.replay_ratio))
+            replay_docs = random.sample(range(trained_docs), n_replay)
+            epochs = self.fine_tune_epochs
+
+        doc_ids = list(new_docs) + replay_docs
+        token_ids = self.token_ids(new_docs.stop)
+        self.content_generator.train_ids(token_ids[doc_ids], epochs=epochs)
+
+        self.state["trained_docs"] = new_docs.stop
+        self.state["last_run"] = time.time()
+        with open(self.STATE_PATH, "w") as f:
+            json.dump(self.state, f)
+
+        report = {
+            "new_docs": len(new_docs),
+            "replay_docs": len(replay_docs),
+            "epochs": epochs,
+            "wall_time": time.perf_counter() - wall_start,
+            "cpu_time": time.process_time() - cpu_start,
+        }
+        print(f"[INFO] Content generator training: {report}")
+        return report
+
+    def token_ids(self, n_docs: int) -> np.ndarray:
+        """
+        returns:
+            np.ndarray: (n_docs, n_grams) token ids of the first n_docs documents,
+            only the documents that were never vectorized with the current
+            vocabulary are vectorized
+        """
+        token_ids = np.zeros((0, self.content_generator.n_grams), dtype=np.int32)
+        vocabulary_hash = self._vocabulary_hash()
+        if os.path.exists(self.TOKEN_IDS_PATH):
+            with np.load(self.TOKEN_IDS_PATH) as data:
+                if (
+                    "vocabulary_hash" in data.files
+                    and str(data["vocabulary_hash"]) == vocabulary_hash
+                ):
+                    token_ids = data["token_ids"][:n_docs]
+
+        if len(token_ids) < n_docs:
+            new_ids = self.content_generator.vectorize_texts(
+                self._texts(range(len(token_ids), n_docs))
+            )
+            token_ids = np.concatenate([token_ids, new_ids])
+            tmp_path = self.TOKEN_IDS_PATH + ".tmp"
+            with open(tmp_path, "wb") as f:
+                np.savez(
+                    f,
+                    token_ids=token_ids,
+                    vocabulary_hash=np.array(vocabulary_hash),
+                )
+            os.replace(tmp_path, self.TOKEN_IDS_PATH)
+        return token_ids
+
+    def _vocabulary_hash(self) -> str:
+        # The saved ids are only valid for the exact vocabulary they were made with
+        words = "\n".join(self.content_generator.vocabulary.tolist())
+        return hashlib.blake2b(words.encode("utf-8"), digest_size=16).hexdigest()
+
+    def _texts(self, doc_ids):
+        # Re-iterable, the dataset iterates it once per epoch
+        return _LazyTexts(self.contents, list(doc_ids))
+
+
+class _LazyTexts:
+    def __init__(self, contents, doc_ids: list) -> None:
+        self.contents = contents
+        self.doc_ids = doc_ids
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+    def __iter__(self):
+        for doc_id in self.doc_ids:
+            yield self.contents[doc_id]
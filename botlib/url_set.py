@@ -0,0 +1,122 @@
+import hashlib
+import math
+import os
+from urllib.parse import urlsplit, urlunsplit
+import numpy as np
+
+_DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def normalize_url(url: str) -> str:
+    """
+    Lowercases the scheme and host, drops the default port, the fragment and the
+    trailing slash of the path, so the variants of an url are seen as one.
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    try:
+        port = parts.port
+    except ValueError:
+        port = None
+    if port and port != _DEFAULT_PORTS.get(scheme):
+        host = f"{host}:{port}"
+    path = parts.path.rstrip("/")
+    return urlunsplit((scheme, host, path, parts.query, ""))
+
+
+def url_hash(url: str) -> int:
+    """
+    returns:
+        int: 64 bits hash of the normalized url
+    """
+    digest = hashlib.blake2b(normalize_url(url).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+class UrlHashSet:
+    """
+    Persistent set of urls seen by the scraper, kept as their 64 bits hashes
+    (8 bytes per url instead of the url string and a set entry).
+
+    The hashes are in a sorted array, searched with a binary search, and the ones
+    added since the last merge in a small set. The file has the hashes in the order
+    they were added (for the stored urls, the doc id order) and is only appended to.
+    """
+
+    # Hashes added before they are merged into the sorted array
+    MERGE_SIZE = 65536
+
+    def __init__(self, path: str = "data/seen_urls.bin") -> None:
+        self.path = path
+        if os.path.exists(path):
+            hashes = np.fromfile(path, dtype=np.uint64)
+        else:
+            hashes = np.array([], dtype=np.uint64)
+        self.n_urls = len(hashes)
+        self._sorted = np.unique(hashes)
+        self._recent: set = set()
+
+    def __len__(self) -> int:
+        return self.n_urls
+
+    def __contains__(self, url: str) -> bool:
+        return self.contains_hash(url_hash(url))
+
+    def contains_hash(self, h: int) -> bool:
+        if h in self._recent:
+            return True
+        position = np.searchsorted(self._sorted, np.uint64(h))
+        return position < len(self._sorted) and self._sorted[position] == h
+
+    def add(self, url: str) -> None:
+        self.add_hashes([url_hash(url)])
+
+    def add_hashes(self, hashes: list) -> None:
+        with open(self.path, "ab") as f:
+            f.write(np.array(hashes, dtype=np.uint64).tobytes())
+        self.n_urls += len(hashes)
+        self._recent.update(hashes)
+        if len(self._recent) >= self.MERGE_SIZE:
+            recent = np.fromiter(self._recent, dtype=np.uint64, count=len(self._recent))
+            self._sorted = np.union1d(self._sorted, recent)
+            self._recent = set()
+
+    def truncate(self, n_urls: int) -> None:
+        """Keeps only the first n_urls hashes (after a crash left extra ones)"""
+        hashes = np.fromfile(self.path, dtype=np.uint64)[:n_urls]
+        hashes.tofile(self.path)
+        self.n_urls = len(hashes)
+        self._sorted = np.unique(hashes)
+        self._recent = set()
+
+
+class BloomFilter:
+    """
+    Fixed size set of url hashes with a false positive rate of about error_rate
+    once it has capacity items, and no false negatives.
+
+    The bit positions come from the two 32 bits halves of the url hash (double
+    hashing), so an url is hashed only once.
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.001) -> None:
+        self.n_bits = max(
+            int(-capacity * math.log(error_rate) / (math.log(2) ** 2)), 64
+        )
+        self.n_hashes = max(round(self.n_bits / capacity * math.log(2)), 1)
+        self.bits = np.zeros((self.n_bits + 7) // 8, dtype=np.uint8)
+
+    def __contains__(self, h: int) -> bool:
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(h)
+        )
+
+    def add(self, h: int) -> None:
+        for position in self._positions(h):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def _positions(self, h: int) -> list:
+        h1, h2 = h & 0xFFFFFFFF, (h >> 32) | 1
+        return [(h1 + i * h2) % self.n_bits for i in range(self.n_hashes)]
@@ -2,16 +2,25 @@ import discord
 from discord.ext import commands
 import os
 from datetime import datetime
+from io import BytesIO
 from dotenv import load_dotenv
 from botlib import (
     CommandsHelp,
     ApiInterface,
+    HttpClient,
     Scraper,
     NlpTools,
+    IngestionPipeline,
+    SearchIndex,
     InvalidCrypto,
     FetchError,
+    QueueFull,
+    GenerationScheduler,
+    load_report,
+    stream_in_executor,
 )
 import asyncio
+import time
 
 load_dotenv()
 API_KEY = os.getenv("API_KEY")
@@ -21,16 +30,71 @@ if not API_KEY or not TOKEN:
 
 N_RESULTS_SEARCH = 12
 MAX_SCRAPER_DOWNLOADS = 25
+MAX_CRAWL_CONCURRENCY = 8
+# Models loaded in the background once the bot is ready, instead of on first use
+WARM_UP_MODELS = True
+WARM_UP_GPT = False
+# GPT-2 requests waiting at most, prompts generated together and at the same time
+GPT_QUEUE_SIZE = 16
+GPT_MAX_BATCH_SIZE = 4
+GPT_MAX_CONCURRENCY = 1
+# Generated text is shown while it is generated, editing a single message (for GPT-2
+# only when no other request is batched with it)
+STREAM_GENERATION = True
+STREAM_EDIT_INTERVAL = 1.0
+DISCORD_MAX_MESSAGE_LENGTH = 2000
+
+
+class ChatBot(commands.Bot):
+    async def close(self):
+        # The shared http session must be closed before the event loop
+        await http_client.close()
+        await super().close()
+
+
 intents = discord.Intents().all()
-bot = commands.Bot(command_prefix="!", intents=intents, help_command=CommandsHelp())
-api_interface = ApiInterface(API_KEY)
-scrapper = Scraper(max_downloads=MAX_SCRAPER_DOWNLOADS)
-nlp_tools = NlpTools(scrapper)
+bot = ChatBot(command_prefix="!", intents=intents, help_command=CommandsHelp())
+http_client = HttpClient()
+with load_report.measure("api interface"):
+    api_interface = ApiInterface(API_KEY, http_client)
+with load_report.measure("scraper"):
+    scrapper = Scraper(
+        http_client,
+        max_downloads=MAX_SCRAPER_DOWNLOADS,
+        max_concurrency=MAX_CRAWL_CONCURRENCY,
+    )
+with load_report.measure("nlp tools"):
+    nlp_tools = NlpTools(scrapper)
+ingestion = IngestionPipeline(nlp_tools)
+gpt_scheduler = GenerationScheduler(
+    nlp_tools.content_generator.gpt_generate_batch,
+    nlp_tools.content_generator.gpt_generate_stream,
+    max_queue_size=GPT_QUEUE_SIZE,
+    max_batch_size=GPT_MAX_BATCH_SIZE,
+    max_concurrency=GPT_MAX_CONCURRENCY,
+)
+training_task = None
+warm_up_task = None
+unindexed_task = None
+print(f"[INFO] Startup report:\n{load_report.summary()}")
+
+
+async def warm_up_models():
+    loop = asyncio.get_running_loop()
+    report = await loop.run_in_executor(None, nlp_tools.warm_up, WARM_UP_GPT)
+    print(f"[INFO] Models warmed up:\n{report}")
 
 
 @bot.event
 async def on_ready():
+    global training_task, warm_up_task, unindexed_task
     print(f"Bot is ready! {bot.user}")
+    if training_task is None:
+        training_task = asyncio.create_task(ingestion.run_training_schedule())
+    if unindexed_task is None:
+        unindexed_task = asyncio.create_task(ingestion.index_unindexed())
+    if WARM_UP_MODELS and warm_up_task is None:
+        warm_up_task = asyncio.create_task(warm_up_models())
 
 
 @bot.command(help="Sends a link to the github repo", usage="!source")
@@ -60,69 +124,103 @@ async def author(ctx):
     await ctx.send(embed=embed)
 
 
+def format_price(price: float) -> str:
+    if price > 1:
+        return f"${price:,.3f}"
+    return f"${price:,.6f}"
+
+
 @bot.command(
-    help="Command to list info on a specific cryptocurrency.",
-    usage="!run BTC 2020-01-01.2021-01-01",
+    help="Command to list info on one or more cryptocurrencies.",
+    usage="!run BTC [ETH ...] 2020-01-01.2021-01-01",
 )
-async def run(ctx, symbol: str, interval: str = None):
+async def run(ctx, *args):
     """
-    This command uses the **coincap API** to fetch data on a specific cryptocurrency.
+    This command uses the **coincap API** to fetch data on one or more cryptocurrencies.
     The data is then to the user on a discord embed with a historical price graph and basic info on the crypto.
+    With more than one symbol, the graph compares the return (in percent) of each crypto.
 
     Parameters:
-        :symbol: The symbol of the cryptocurrency to fetch data on, must be on the crypto typical format (e.g. BTC, ETH, XRP, etc.)
+        :symbols: The symbols of the cryptocurrencies to fetch data on, must be on the crypto typical format (e.g. BTC, ETH, XRP, etc.)
         :interval: The interval of the historical price graph. This parameter is optional and defaults to the last one year.
         The format must be YYYY-MM-DD.YYYY-MM-DD, where the first date is the start date and the second is the end date, separated by a dot.
 
     **Example usage:**
         !run BTC 2020-01-01.2021-01-01
     This command will fetch data on BTC from the 1st of January 2020 to the 1st of January 2021.
+        !run BTC ETH SOL
+    This command will compare BTC, ETH and SOL over the last year.
     """
-    embed = discord.Embed(title=f"Information on {symbol}")
-
-    if api_interface.validate_symbol(symbol):
-        first_date = None
-        second_date = None
-        if interval and api_interface.validate_interval(interval):
-            first, second = interval.split(".")
-            first_date = datetime.strptime(first, "%Y-%m-%d")
-            second_date = datetime.strptime(second, "%Y-%m-%d")
-
-            if first_date > second_date:
-                first_date, second_date = second_date, first_date
-        try:
-            async with ctx.typing():
-                basic_info, img_path = await api_interface.fetch_data(
+    symbols = list(args)
+    interval = None
+    if symbols and api_interface.validate_interval(symbols[-1]):
+        interval = symbols.pop()
+
+    if not symbols or not all(map(api_interface.validate_symbol, symbols)):
+        await ctx.send("Invalid symbol, see the usage of the command with !help run")
+        return
+    if len(symbols) > ApiInterface.MAX_COMPARE_ASSETS:
+        await ctx.send(
+            f"At most {ApiInterface.MAX_COMPARE_ASSETS} cryptos can be compared at once"
+        )
+        return
+
+    first_date = None
+    second_date = None
+    if interval:
+        first, second = interval.split(".")
+        first_date = datetime.strptime(first, "%Y-%m-%d")
+        second_date = datetime.strptime(second, "%Y-%m-%d")
+
+        if first_date > second_date:
+            first_date, second_date = second_date, first_date
+    try:
+        async with ctx.typing():
+            if len(symbols) == 1:
+                symbol = symbols[0]
+                basic_info, image = await api_interface.fetch_data(
                     symbol, first_date, second_date
                 )
+                embed = discord.Embed(title=f"Information on {symbol}")
 
                 market_cap_usd = f"${float(basic_info['marketCapUsd']):,.2f}"
                 volume_usd = f"${float(basic_info['volumeUsd24Hr']):,.2f}"
                 change = f"{float(basic_info['changePercent24Hr']):.2f} %"
-                price = float(basic_info["priceUsd"])
-                if price > 1:
-                    price = f"${price:,.3f}"
-                else:
-                    price = f"${price:,.6f}"
+                price = format_price(float(basic_info["priceUsd"]))
 
                 embed.add_field(name="Crypto rank", value=basic_info["rank"])
                 embed.add_field(name="Price", value=price)
                 embed.add_field(name="Market Cap", value=market_cap_usd, inline=False)
                 embed.add_field(name="Volume in 24h", value=volume_usd)
                 embed.add_field(name="Change in 24h", value=change)
-                embed.set_image(url=f"attachment://{img_path}")
-
-                await ctx.send(embed=embed, file=discord.File(img_path))
-                os.remove(img_path)
-        except InvalidCrypto as e:
-            embed = discord.Embed(title=e)
-            valid_crypto_str = ", ".join(e.get_valid_cryptos())
-            embed.add_field(name="Valid cryptos:", value=valid_crypto_str)
-            await ctx.send(embed=embed)
-        except FetchError as e:
-            await ctx.send(f"{e}")
-    else:
-        await ctx.send("Invalid symbol, see the usage of the command with !help run")
+                image_name = f"{symbol.lower()}.png"
+            else:
+                basic_infos, image = await api_interface.fetch_comparison(
+                    symbols, first_date, second_date
+                )
+                embed = discord.Embed(title=f"Comparison of {', '.join(symbols)}")
+
+                for basic_info in basic_infos:
+                    price = format_price(float(basic_info["priceUsd"]))
+                    change = f"{float(basic_info['changePercent24Hr']):.2f} %"
+                    embed.add_field(
+                        name=f"{basic_info['symbol']} (#{basic_info['rank']})",
+                        value=f"{price}\n{change} in 24h",
+                    )
+                image_name = "comparison.png"
+
+            # Sent from memory, concurrent commands don't share any file
+            embed.set_image(url=f"attachment://{image_name}")
+            await ctx.send(
+                embed=embed, file=discord.File(BytesIO(image), filename=image_name)
+            )
+    except InvalidCrypto as e:
+        embed = discord.Embed(title=e)
+        valid_crypto_str = ", ".join(e.get_valid_cryptos())
+        embed.add_field(name="Valid cryptos:", value=valid_crypto_str)
+        await ctx.send(embed=embed)
+    except FetchError as e:
+        await ctx.send(f"{e}")
 
 
 @bot.command(
@@ -144,19 +242,48 @@ async def crawl(ctx, url: str):
         await ctx.send("This url has already been added to the database")
         return
 
-    contents = []
-    async for title, content in scrapper.scrape(url):
+    loop = asyncio.get_running_loop()
+    documents = []
+    doc_ids = []
+    duplicates = []
+    # The pages are classified while the rest of the crawl is downloading
+    classification = ingestion.classification.start_job()
+    async for doc_id, title, content in scrapper.scrape(url, duplicates):
         await ctx.send(f"Content of <{title}> fetched!")
-        contents.append(content)
-    if len(contents) == 0:
+        # Normalized and tokenized once, for the classifier and the index, outside
+        # of the event loop as the pages can be long
+        document = await loop.run_in_executor(
+            ingestion.classification.executor, nlp_tools.analyze, content
+        )
+        documents.append(document)
+        doc_ids.append(doc_id)
+        classification.add(document)
+    duplicates_text = ""
+    if duplicates:
+        duplicates_text = f", skipped {len(duplicates)} near-duplicate page(s)"
+    if len(documents) == 0:
+        if duplicates:
+            await ctx.send(
+                f"All the pages were near-duplicates of stored ones{duplicates_text}!"
+            )
+            return
         await ctx.send("Could not download the page, try again with other link!")
         return
 
-    nlp_tools.fit_transform()
-    negative_amount = nlp_tools.get_negative_amount_texts(contents)
-    for content, negative in zip(contents, negative_amount):
-        nlp_tools.add_document(content, negative)
-    await ctx.send(f"Finished crawling, crawled {len(contents)} pages!")
+    waiting_text = ""
+    if ingestion.pending_jobs:
+        waiting_text = (
+            f", waiting for {ingestion.pending_jobs} crawl(s) to be processed"
+        )
+    await ctx.send(
+        f"Finished crawling, crawled {len(documents)} pages"
+        f"{duplicates_text}{waiting_text}!"
+    )
+    negative_amounts = await classification.results()
+    # The processing runs outside of the event loop, the bot keeps answering meanwhile
+    job = await ingestion.submit(documents, doc_ids, ctx.send, negative_amounts)
+    n_pages = await job
+    await ctx.send(f"Finished processing {n_pages} pages!")
 
 
 @bot.command(
@@ -166,48 +293,54 @@ async def crawl(ctx, url: str):
 async def search(ctx, *query):
     """
     This command receives a query and searches for it in the database.
-    Returns the documents where the query was found, sorted by TF-IDF score, filtered by negative amount.
+    Returns the documents where the query was found, sorted by TF-IDF (or BM25) score, filtered by negative amount.
 
     Parameters:
         :query: The query to be searched.
         :th=: The threshold to filter the documents by negative amount. This parameter is optional and defaults to -1.0.
+        :mode=: "or" to match any of the words or "and" to match all of them. This parameter is optional and defaults to or.
+        :rank=: "tfidf" or "bm25", the score used to sort the documents. This parameter is optional and defaults to tfidf.
 
     **Example usage: [optional]**
-        !search cloud computing [th=0.5]
+        !search cloud computing [th=0.5] [mode=and] [rank=bm25]
     """
-    # Find th= in the query
+    # Find th=, mode= and rank= in the query
     th = -1.0
-    for i, word in enumerate(query):
-        if "th=" in word:
+    mode = "or"
+    scorer = "tfidf"
+    words = []
+    for word in query:
+        if word.startswith("th="):
             th = float(word.split("th=")[1])
-            query = list(query)
-            query.pop(i)
-            break
-
-    docs = nlp_tools.search(" ".join(query))
-    if not docs:
-        await ctx.send(
-            f"The query {query} was not found in the database, please try another query or try using wn_search."
-        )
+        elif word.startswith("mode="):
+            mode = word.split("mode=")[1].lower()
+        elif word.startswith("rank="):
+            scorer = word.split("rank=")[1].lower()
+        else:
+            words.append(word)
+    query = " ".join(words)
+
+    if mode not in SearchIndex.MODES or scorer not in SearchIndex.SCORERS:
+        await ctx.send("Invalid mode= or rank=, see the usage with !help search")
         return
-    th_text = f"with threshold {th}" if th != -1.0 else ""
-    embed = discord.Embed(title=f"Best matches for {' '.join(query)} {th_text}")
-    # docs[x][0] -> TF-IDF score, docs[x][1] -> negative amount
-    # Filter by negative amount
-    docs = {doc: docs[doc] for doc in docs if docs[doc][1] >= th}
+
+    docs = nlp_tools.search(query, N_RESULTS_SEARCH, mode, scorer, min_negativity=th)
     if not docs:
-        await ctx.send(
-            f"All results had a negative amount higher than the threshold, please try another query."
-        )
+        if not nlp_tools.search(query, 1, mode, scorer):
+            await ctx.send(
+                f"The query {query} was not found in the database, please try another query or try using wn_search."
+            )
+        else:
+            await ctx.send(
+                f"All results had a negative amount higher than the threshold, please try another query."
+            )
         return
-    docs = sorted(docs, key=lambda x: docs[x][0], reverse=True)
 
-    for i, doc in enumerate(docs):
-        if i >= N_RESULTS_SEARCH:
-            break
-        embed.add_field(
-            name=f"{scrapper.titles[int(doc)]}", value=scrapper.urls[int(doc)]
-        )
+    th_text = f"with threshold {th}" if th != -1.0 else ""
+    embed = discord.Embed(title=f"Best matches for {query} {th_text}")
+    # Already sorted by score and filtered by negative amount
+    for doc, score, negative_amount in docs:
+        embed.add_field(name=f"{scrapper.titles[doc]}", value=scrapper.urls[doc])
     await ctx.send(embed=embed)
 
 
@@ -231,7 +364,12 @@ async def wn_search(ctx, word: str, th=None):
     else:
         # Default threshold
         th = -1.0
-    match, docs = nlp_tools.wn_search(word)
+    loop = asyncio.get_running_loop()
+    # wup_similarity over the indexed terms (and loading WordNet), off the event loop
+    match, docs = await loop.run_in_executor(
+        None,
+        lambda: nlp_tools.wn_search(word, N_RESULTS_SEARCH, min_negativity=th),
+    )
     if not match:
         await ctx.send(
             f"The word {word} was not found in the wordnet, please try another word."
@@ -246,20 +384,9 @@ async def wn_search(ctx, word: str, th=None):
     th_text = f"with threshold {th}" if th != -1.0 else ""
     embed = discord.Embed(title=f"Found matches for {match} {th_text}")
 
-    docs = {doc: docs[doc] for doc in docs if docs[doc][1] >= th}
-    if not docs:
-        await ctx.send(
-            f"All results had a negative amount higher than the threshold, please try another query."
-        )
-        return
-
-    docs = sorted(docs, key=lambda x: docs[x][0], reverse=True)
-
-    for i, doc in enumerate(docs):
-        if i >= N_RESULTS_SEARCH:
-            break
+    for doc, score, negative_amount in docs:
         embed.add_field(
-            name=f"Document {scrapper.titles[int(doc)]}", value=scrapper.urls[int(doc)]
+            name=f"Document {scrapper.titles[doc]}", value=scrapper.urls[doc]
         )
     await ctx.send(embed=embed)
 
@@ -278,13 +405,54 @@ async def generate(ctx, *query):
     **Example usage:**
         !generate cloud computing
     """
-    generated_text = nlp_tools.generate_text(" ".join(query), "inhouse")
-    if generated_text is None:
+    loop = asyncio.get_running_loop()
+    # The WordNet fallback can take a while, it must not block the event loop
+    page = await loop.run_in_executor(
+        None, nlp_tools.generation_context, " ".join(query)
+    )
+    if page is None:
         await ctx.send(
             "Could not find any documents with the query, please try another query."
         )
         return
-    await ctx.send(generated_text)
+
+    generate_stream = nlp_tools.content_generator.generate_content_stream
+    if STREAM_GENERATION:
+        await send_streaming(ctx, stream_in_executor(None, generate_stream, page), " ")
+    else:
+        words = await loop.run_in_executor(None, lambda: list(generate_stream(page)))
+        await ctx.send(" ".join(words))
+
+
+async def send_streaming(ctx, chunks, separator: str = "") -> str:
+    """
+    Sends the text while it is generated, editing a single message at most once
+    every STREAM_EDIT_INTERVAL seconds (the chunks that arrive in between are
+    shown together), so the rate limits of discord are respected.
+
+    returns:
+        str: the whole text
+    """
+    message = None
+    text = ""
+    shown = ""
+    last_edit = 0.0
+    async for chunk in chunks:
+        text = f"{text}{separator}{chunk}" if text else chunk
+        if text.strip() and time.monotonic() - last_edit >= STREAM_EDIT_INTERVAL:
+            shown = text
+            if message is None:
+                message = await ctx.send(shown[:DISCORD_MAX_MESSAGE_LENGTH])
+            else:
+                await message.edit(content=shown[:DISCORD_MAX_MESSAGE_LENGTH])
+            last_edit = time.monotonic()
+
+    if text != shown and text.strip():
+        if message is None:
+            await ctx.send(text[:DISCORD_MAX_MESSAGE_LENGTH])
+        else:
+            await message.edit(content=text[:DISCORD_MAX_MESSAGE_LENGTH])
+    return text
 
 
 @bot.command(
@@ -301,20 +469,83 @@ async def gptgenerate(ctx, *query):
     **Example usage:**
         !gptgenerate python
     """
-    async with ctx.typing():
-        await ctx.send("Generating text, it may take a while, please wait....")
-        loop = asyncio.get_event_loop()
-        generated_text = await loop.run_in_executor(
-            None, nlp_tools.generate_text, " ".join(query), "gpt"
+    loop = asyncio.get_running_loop()
+    # The WordNet fallback can take a while, it must not block the event loop
+    page = await loop.run_in_executor(
+        None, nlp_tools.generation_context, " ".join(query)
+    )
+    if page is None:
+        await ctx.send(
+            "Could not find any documents with the query, please try another query."
         )
-        if generated_text is None:
+        return
+
+    try:
+        # Requests close together are generated in a single batch, only a request
+        # generated alone is streamed
+        job, position, eta = await gpt_scheduler.submit(page, stream=STREAM_GENERATION)
+    except QueueFull as e:
+        await ctx.send(f"{e}")
+        return
+
+    async with ctx.typing():
+        if eta:
             await ctx.send(
-                "Could not find any documents with the query, please try another query."
+                f"Generating text, position {position} in the queue, "
+                f"about {eta:.0f}s, please wait...."
             )
+        else:
+            await ctx.send("Generating text, it may take a while, please wait....")
+        if STREAM_GENERATION:
+            await send_streaming(ctx, job)
             return
+        generated_text = await job
     await ctx.send(generated_text)
 
 
+@bot.command(help="Sends the bot's cache statistics", usage="!stats")
+async def stats(ctx):
+    """
+    Sends a embed with the hits and misses of the bot's caches, the http connection reuse
+    and the throughput of the page classification.
+    """
+    embed = discord.Embed(title="Bot statistics")
+    cache_stats = nlp_tools.query_cache.stats()
+    embed.add_field(
+        name="Search cache",
+        value=f"{cache_stats['hits']} hits, {cache_stats['misses']} misses "
+        f"({cache_stats['hit_rate']:.0%} hit rate, {cache_stats['size']} entries)",
+        inline=False,
+    )
+    http_stats = http_client.stats()
+    embed.add_field(
+        name="HTTP connections",
+        value=f"{http_stats['requests']} requests, "
+        f"{http_stats['connections_created']} connections created, "
+        f"{http_stats['connections_reused']} reused "
+        f"({http_stats['reuse_rate']:.0%} reuse rate)",
+        inline=False,
+    )
+    gpt_stats = gpt_scheduler.stats()
+    embed.add_field(
+        name="GPT-2 queue",
+        value=f"{gpt_stats['queued']} queued, {gpt_stats['running']} generating, "
+        f"{gpt_stats['mean_batch_time']:.1f}s per batch",
+        inline=False,
+    )
+    classification_stats = ingestion.classification.stats()
+    embed.add_field(
+        name="Classification",
+        value=f"{classification_stats['docs']} pages in "
+        f"{classification_stats['batches']} batches, "
+        f"{classification_stats['docs_per_second']:.1f} pages/s, "
+        f"{classification_stats['mean_latency'] * 1e3:.0f} ms per batch "
+        f"(p95 {classification_stats['p95_latency'] * 1e3:.0f} ms)",
+        inline=False,
+    )
+    await ctx.send(embed=embed)
+
+
 @bot.event
 async def on_command_error(ctx, exception):
     if isinstance(exception, commands.MissingRequiredArgument):
@@ -323,11 +554,9 @@ async def on_command_error(ctx, exception):
             f"Command missing argument, please use **!help {command_name}** to see how to use it."
         )
 
-    print(
-        f"""Error:
+    print(f"""Error:
             {exception}
-        """
-    )
+        """)
 
 
 bot.run(TOKEN)
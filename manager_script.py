@@ -1,9 +1,20 @@
 import argparse
 import os
+import shutil
 
-# Run this script with python manager_script.py <setup | cleanup>
-parser = argparse.ArgumentParser(description="Perform setup or cleanup operation.")
-parser.add_argument("mode", choices=["setup", "cleanup"], help="select operation mode")
+# Run this script with python manager_script.py <setup | cleanup | export>
+parser = argparse.ArgumentParser(
+    description="Perform setup, cleanup or export operation."
+)
+parser.add_argument(
+    "mode", choices=["setup", "cleanup", "export"], help="select operation mode"
+)
+parser.add_argument(
+    "--quantization",
+    choices=["dynamic", "float16"],
+    default="dynamic",
+    help="weights quantization of the exported models (export mode)",
+)
 
 args = parser.parse_args()
 
@@ -14,9 +25,23 @@ if args.mode == "setup":
     nltk.download("wordnet")
 elif args.mode == "cleanup":
     print("Running cleanup...")
-    # Delete all Docs files, data/index.json, data/urls.pickle and data/contents.pickle
+    # Delete all the generated files in data/ (Docs, store, index, synsets, prices and the old pickles)
     for file in os.listdir("data/Docs"):
         os.remove(os.path.join("data/Docs", file))
+    if os.path.exists("data/store"):
+        shutil.rmtree("data/store")
+    if os.path.exists("data/index"):
+        shutil.rmtree("data/index")
+    if os.path.exists("data/prices"):
+        shutil.rmtree("data/prices")
+    if os.path.exists("data/synsets.json"):
+        os.remove("data/synsets.json")
+    if os.path.exists("data/near_duplicates.npz"):
+        os.remove("data/near_duplicates.npz")
+    if os.path.exists("data/seen_urls.bin"):
+        os.remove("data/seen_urls.bin")
+    if os.path.exists("data/skipped_urls.bin"):
+        os.remove("data/skipped_urls.bin")
     if os.path.exists("data/index.json"):
         os.remove("data/index.json")
     if os.path.exists("data/urls.pickle"):
@@ -25,3 +50,77 @@ elif args.mode == "cleanup":
         os.remove("data/contents.pickle")
     if os.path.exists("data/titles.pickle"):
         os.remove("data/titles.pickle")
+    # Training state derived from the documents, a new corpus starts over
+    if os.path.exists("models/token_ids.npz"):
+        os.remove("models/token_ids.npz")
+    if os.path.exists("models/vocabulary.npz"):
+        os.remove("models/vocabulary.npz")
+    if os.path.exists("models/training_state.json"):
+        os.remove("models/training_state.json")
+elif args.mode == "export":
+    print("Running export...")
+    # Converts the classifier and the content generator to quantized TFLite models,
+    # the bot uses them instead of the Keras ones while they are up to date.
+    import json
+    import itertools
+    import numpy as np
+    import tensorflow as tf
+    from botlib.content_generator import ContentGenerator
+    from botlib.document_store import DocumentStore
+    from botlib.nlp_tools import NlpTools
+    from botlib.scraper import Scraper
+    from botlib.tflite_models import TFLiteModel, export_tflite, compare_models
+
+    texts = []
+    if os.path.exists(Scraper.STORE_PATH):
+        store = DocumentStore(Scraper.STORE_PATH)
+        texts = list(itertools.islice(store.iter_contents(), 64))
+    if not texts:
+        texts = ["I love my job.", "I hate my job.", "The day is wonderful."] * 8
+
+    report = {}
+    models = [
+        (
+            "classifier",
+            NlpTools.CLASSIFIER_PATH,
+            NlpTools.CLASSIFIER_TFLITE_PATH,
+            [
+                np.array(texts[i : i + 16], dtype=object)
+                for i in range(0, len(texts), 16)
+            ],
+        ),
+        (
+            "content_generator",
+            ContentGenerator.MODEL_PATH,
+            ContentGenerator.TFLITE_PATH,
+            None,
+        ),
+    ]
+    for name, source_path, tflite_path, batches in models:
+        if not os.path.exists(source_path):
+            print(f"[INFO] {source_path} not found, skipping the {name}")
+            continue
+        print(f"[INFO] Exporting the {name}...")
+        model = tf.keras.models.load_model(source_path)
+        meta = export_tflite(model, tflite_path, source_path, args.quantization)
+        if batches is None:
+            # Single windows of token ids, as in the generation
+            rng = np.random.default_rng(42)
+            window = model.inputs[0].shape[1]
+            batches = [
+                rng.integers(0, model.outputs[0].shape[-1], size=(1, window))
+                for _ in range(32)
+            ]
+        report[name] = {
+            **meta,
+            "source_size": sum(
+                os.path.getsize(os.path.join(root, file))
+                for root, _, files in os.walk(source_path)
+                for file in files
+            ),
+            **compare_models(model, TFLiteModel(tflite_path), batches),
+        }
+        print(f"[INFO] {name}: {report[name]}")
+
+    with open("models/tflite_report.json", "w") as f:
+        json.dump(report, f, indent=2)